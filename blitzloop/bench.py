@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Benchmarks for the text rendering paths, run against real songs without a
+# display:
+#
+#   python -m blitzloop.bench atlas [--glyphs N] SONG.blitz...
+#   python -m blitzloop.bench rows
+
+import os
+import random
+import sys
+import time
+
+from blitzloop import layout, song, texture_font, util
+
+class HeadlessDisplay(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def round_coord(self, c):
+        return int(round(c * self.width)) / self.width
+
+    @property
+    def top(self):
+        return self.height / self.width
+
+class HeadlessRenderer(object):
+    def __init__(self, width, height):
+        self.display = HeadlessDisplay(width, height)
+
+class LegacyTextureAtlas(texture_font.TextureAtlas):
+    '''
+    The original skyline packer, which walks every node for every region.
+    Kept to compare the current one against.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        texture_font.TextureAtlas.__init__(self, *args, **kwargs)
+        self.nodes = [ (0,0,self.width), ]
+
+    def get_region(self, width, height):
+        best_height = sys.maxsize
+        best_index = None
+        best_width = sys.maxsize
+        region = 0, 0, width, height
+
+        for i in range(len(self.nodes)):
+            y = self.fit(i, width, height)
+            if y is not None:
+                node = self.nodes[i]
+                if (y+height < best_height or
+                    (y+height == best_height and node[2] < best_width)):
+                    best_height = y+height
+                    best_index = i
+                    best_width = node[2]
+                    region = node[0], y, width, height
+
+        if best_index is None:
+            return None
+
+        node = region[0], region[1]+height, width
+        self.nodes.insert(best_index, node)
+
+        i = best_index+1
+        while i < len(self.nodes):
+            node = self.nodes[i]
+            prev_node = self.nodes[i-1]
+            if node[0] < prev_node[0]+prev_node[2]:
+                shrink = prev_node[0]+prev_node[2] - node[0]
+                x,y,w = self.nodes[i]
+                self.nodes[i] = x+shrink, y, w-shrink
+                if self.nodes[i][2] <= 0:
+                    del self.nodes[i]
+                    i -= 1
+                else:
+                    break
+            else:
+                break
+            i += 1
+
+        self.merge()
+        self.used += width*height
+        return region
+
+    def fit(self, index, width, height):
+        node = self.nodes[index]
+        x,y = node[0], node[1]
+        width_left = width
+
+        if x+width > self.width:
+            return None
+
+        i = index
+        while width_left > 0:
+            node = self.nodes[i]
+            y = max(y, node[1])
+            if y+height > self.height:
+                return None
+            width_left -= node[2]
+            i += 1
+        return y
+
+    def merge(self):
+        i = 0
+        while i < len(self.nodes)-1:
+            node = self.nodes[i]
+            next_node = self.nodes[i+1]
+            if node[1] == next_node[1]:
+                self.nodes[i] = node[0], node[1], node[2]+next_node[2]
+                del self.nodes[i+1]
+            else:
+                i += 1
+
+def legacy_layout_lines(self, lines, top=False):
+    '''
+    The original SongLayout._layout_lines, which scans and re-sorts plain
+    lists for every row change. Kept to check the current one against.
+    '''
+    if not lines:
+        return
+    rows = [[] for i in range(10)]
+    lines.sort(key = lambda x: x.start)
+
+    def sortrow(rowid):
+        rows[rowid].sort(key = lambda x: x.start)
+
+    def collides(l, rowid):
+        c = []
+        for l2 in rows[rowid][::-1]:
+            if l.start >= l2.end:
+                return c
+            elif l.end <= l2.start:
+                continue
+            else:
+                c.append(l2)
+        else:
+            return c
+
+    def canmoveup(l, limit=1):
+        if l.row >= limit:
+            return False
+        for l2 in collides(l, l.row + 1):
+            if not canmoveup(l2, limit):
+                return False
+        return True
+
+    def moveup(l, limit=1):
+        assert l.row < limit
+        for l2 in collides(l, l.row + 1):
+            moveup(l2, limit)
+        rows[l.row].remove(l)
+        sortrow(l.row)
+        l.row += 1
+        assert not collides(l, l.row)
+        rows[l.row].append(l)
+        sortrow(l.row)
+
+    def canmovetop(l):
+        return True
+
+    def movetop(l):
+            if l.row == 0:
+                # FIXME: this can cause another line to violate the
+                # "no jumping ahead" rule. meh.
+                for row in range(len(rows)):
+                    if collides(l, row):
+                        need_row = row + 1
+            else:
+                need_row = l.row - 1
+                for l2 in collides(l, need_row):
+                    movetop(l2)
+            rows[l.row].remove(l)
+            sortrow(l.row)
+            l.row = need_row
+            rows[l.row].append(l)
+            sortrow(l.row)
+
+    if not top:
+        for i, l in enumerate(lines):
+            if l.want_row is not None and not collides(l, l.want_row):
+                l.row = l.want_row
+                rows[l.want_row].append(l)
+            elif not collides(l, 1):
+                l.row = 1
+                rows[1].append(l)
+            elif not collides(l, 0):
+                l.row = 0
+                rows[0].append(l)
+            else:
+                need_row = 2
+                while collides(l, need_row):
+                    need_row += 1
+                for want_row in (lines[i-1].row,):
+                    if canmoveup(rows[want_row][-1], need_row):
+                        moveup(rows[want_row][-1], need_row)
+                        l.row = want_row
+                        rows[want_row].append(l)
+                        break
+                else:
+                    l.row = need_row
+                    rows[need_row].append(l)
+    else:
+        for i, l in enumerate(lines):
+            for row in range(len(rows)):
+                if not collides(l, row):
+                    need_row = row
+                    break
+            if i == 0 or need_row <= (lines[i-1].row + 1):
+                l.row = need_row
+                rows[need_row].append(l)
+            else:
+                for want_row in (lines[i-1].row, lines[i-1].row + 1):
+                    if canmovetop(rows[want_row][-1]):
+                        movetop(rows[want_row][-1])
+                        l.row = want_row
+                        rows[want_row].append(l)
+                        break
+                else:
+                    l.row = need_row
+                    rows[need_row].append(l)
+
+    max_ascender = max(l.ascender for l in lines)
+    min_descender = min(l.descender for l in lines)
+    max_spacing = max(l.layout_options["line_spacing"] for l in lines)
+    row_height = (max_ascender - min_descender) + max_spacing
+
+    lastrow = 1 if top else -1
+    max_end = 0
+    prev_l = None
+    for i, l in enumerate(lines):
+        next_l = lines[i+1] if i < len(lines)-1 else None
+        if not top:
+            if l.row == 0:
+                l.align = 1.0 # right
+            elif (l.start >= max_end or l.row > lastrow) and (max_end > l.end or (next_l and next_l.start < l.end)):
+                l.align = 0.0 # left
+            else:
+                l.align = 0.5 # center
+        else:
+            if (l.start >= max_end or l.row < lastrow) and (max_end > l.end or (next_l and next_l.start < l.end)):
+                l.align = 0.0 # left
+            elif l.row >= 1 and not (next_l and next_l.row > l.row) and (max_end > l.end or (next_l and next_l.start < l.end)):
+                l.align = 1.0 # right
+            else:
+                l.align = 0.5 # center
+        l.x = l.layout_options["margin_x"] + l.align * (1.0 - l.layout_options["margin_x"] * 2 - l.width)
+        if max_end > l.start and prev_l:
+            orig_start = l.start
+            l.start = max(min(l.start, prev_l.lim_start), l.start - l.layout_options["early_limit"])
+            if prev_l.row < l.row:
+                l.start = min(orig_start, max(l.start, prev_l.start + l.layout_options["reverse_stagger"]))
+            prev_in_row = rows[l.row].index(l) - 1
+            if prev_in_row >= 0:
+                l.start = max(l.start, rows[l.row][prev_in_row].end)
+        max_end = max(max_end, l.end)
+        lastrow = l.row
+        if not top:
+            l.y = l.layout_options["margin_y"] - min_descender + row_height * l.row
+        else:
+            l.y = self.geometry.top - l.layout_options["margin_y"] - max_ascender - row_height * l.row
+        prev_l = l
+
+def synthetic_lines(count, duet, seed):
+    '''
+    count lines of random length and width, one every 0.5-4s. With duet,
+    lines are longer so several overlap at once, and half of them ask for
+    a row.
+    '''
+    rng = random.Random(seed)
+    display = HeadlessDisplay(1280, 720)
+    lines = []
+    t = 0
+    for i in range(count):
+        l = layout.DisplayLine(display)
+        t += rng.uniform(0.5, 4)
+        l._start_t = t
+        l._end_t = t + rng.uniform(1, 6 if duet else 4)
+        l.start = l.lim_start
+        l.end = l.lim_end
+        l.px = rng.uniform(0.1, 0.86)
+        l.ascender = 0.04
+        l.descender = -0.01
+        if duet and rng.random() < 0.5:
+            l.want_row = rng.randrange(3)
+        lines.append(l)
+    return lines
+
+def synthetic_glyph_sizes(count, seed):
+    '''
+    count random glyph sized regions, 20-60 pixels wide and 30-70 tall,
+    standing in for a glyph set far larger than real songs use.
+    '''
+    rng = random.Random(seed)
+    return [(rng.randint(20, 60), rng.randint(30, 70)) for i in range(count)]
+
+def line_positions(lines):
+    return [(l.row, l.align, l.x, l.y, l.start, l.end) for l in lines]
+
+def song_layouts(paths, width=1280, height=720, atlas=None):
+    renderer = HeadlessRenderer(width, height)
+    for path in paths:
+        s = song.Song(path)
+        for variant in s.variants:
+            yield (path, variant), layout.SongLayout(
+                s, variant, renderer, atlas or texture_font.PagedTextureAtlas(depth=3),
+                build=False)
+
+def glyph_sizes(song_layout):
+    sizes = {}
+    for font in song_layout.fonts.values():
+        for glyph in font.glyphs.values():
+            key = glyph.atlas_key if glyph.atlas_key is not None else id(glyph)
+            sizes[key] = (glyph.pwidth + 2, glyph.pheight + 2)
+    return list(sizes.values())
+
+def pack(atlas, sizes, bulk):
+    t = time.perf_counter()
+    if bulk:
+        regions = atlas.get_regions(sizes)
+    else:
+        regions = [atlas.get_region(*size) for size in sizes]
+    t = time.perf_counter() - t
+    placed = [r for r in regions if r is not None]
+    top = max([y + h for x, y, w, h in placed] or [0])
+    occupancy = atlas.used / float(atlas.width * top) if top else 0
+    return t, len(placed), occupancy
+
+def bench_atlas(opts):
+    '''
+    Pack the glyph set of each song into a single atlas with the legacy
+    packer, the current packer one region at a time, and the current packer
+    in bulk. Occupancy is the glyph area over the atlas area below the
+    highest region. With --glyphs, also pack a synthetic set of that many
+    regions; song glyph sets are usually too small to show a difference.
+    '''
+    packers = [
+        ("legacy", LegacyTextureAtlas, False),
+        ("skyline", texture_font.TextureAtlas, False),
+        ("bulk", texture_font.TextureAtlas, True),
+    ]
+    totals = {name: [0, 0, 0] for name, cls, bulk in packers}
+    def glyph_sets():
+        for (path, variant), song_layout in song_layouts(opts.songs):
+            yield ("%s [%s]" % (os.path.basename(path), variant),
+                   glyph_sizes(song_layout))
+        if opts.glyphs:
+            yield "synthetic", synthetic_glyph_sizes(opts.glyphs, opts.seed)
+    for label, sizes in glyph_sets():
+        results = []
+        for name, cls, bulk in packers:
+            atlas = cls(opts.atlas_size, opts.atlas_size, 1)
+            t, placed, occupancy = pack(atlas, sizes, bulk)
+            totals[name][0] += t
+            totals[name][1] += occupancy
+            totals[name][2] += 1
+            results.append("%s %7.2fms %5.1f%%%s" % (
+                name, t * 1000, occupancy * 100,
+                "" if placed == len(sizes) else " (%d full)" % (len(sizes) - placed)))
+        print("%s %d glyphs: %s" % (label, len(sizes), ", ".join(results)))
+    for name, (t, occupancy, count) in totals.items():
+        if count:
+            print("%-8s total %8.2fms, mean occupancy %5.1f%%" % (
+                name, t * 1000, occupancy * 100 / count))
+
+def bench_rows(opts):
+    '''
+    Assign rows to synthetic songs with the legacy and current row layout,
+    checking that both place every line identically.
+    '''
+    song_layout = layout.SongLayout.__new__(layout.SongLayout)
+    song_layout.renderer = HeadlessRenderer(1280, 720)
+    song_layout.geometry = layout.LayoutGeometry.of(song_layout.renderer.display)
+    for duet in (False, True):
+        for top in (False, True):
+            results = []
+            positions = []
+            for name, layout_lines in (("legacy", legacy_layout_lines),
+                                       ("rows", layout.SongLayout._layout_lines)):
+                lines = synthetic_lines(opts.lines, duet, opts.seed)
+                t = time.perf_counter()
+                try:
+                    layout_lines(song_layout, list(lines), top)
+                except IndexError:
+                    # Ran out of rows, which both versions do the same way
+                    positions.append(None)
+                else:
+                    positions.append(line_positions(lines))
+                t = time.perf_counter() - t
+                results.append("%s %8.2fms" % (name, t * 1000))
+            print("%d lines%s%s: %s, %s" % (
+                opts.lines, ", duet" if duet else "", ", top" if top else "",
+                ", ".join(results),
+                "MISMATCH" if positions[0] != positions[1] else
+                "identical" if positions[0] is not None else "both out of rows"))
+
+BENCHMARKS = {
+    "atlas": bench_atlas,
+    "rows": bench_rows,
+}
+
+def entry():
+    parser = util.get_argparser()
+    parser.add_argument(
+        'benchmark', choices=sorted(BENCHMARKS),
+        help='benchmark to run')
+    parser.add_argument(
+        'songs', metavar='SONG', nargs='*',
+        help='song files to benchmark with')
+    parser.add_argument(
+        '--atlas-size', default=2048, type=int,
+        help='atlas width and height for the atlas benchmark')
+    parser.add_argument(
+        '--glyphs', default=0, type=int,
+        help='number of regions in a synthetic glyph set for the atlas benchmark')
+    parser.add_argument(
+        '--lines', default=1000, type=int,
+        help='number of lines in the synthetic songs for the rows benchmark')
+    parser.add_argument(
+        '--seed', default=0, type=int,
+        help='random seed for the synthetic songs and glyph set')
+    opts = util.get_opts()
+    BENCHMARKS[opts.benchmark](opts)
+
+if __name__ == '__main__':
+    entry()
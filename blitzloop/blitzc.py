@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Compiled songs (.blitzc) hold an already parsed .blitz file: the molecules
+# split into atoms and particles, and the song time of every step of every
+# compound. Loading one does not run the molecule parsers at all.
+#
+# File layout (little endian):
+#   magic "BLZC", u16 format version, u16 marshal version,
+#   u32 header chunk length, u32 body chunk length,
+#   header chunk (marshal): source key, [Meta], [Song], [Timing], [Formats]
+#   body chunk (marshal): [Styles], [Variants], [Lyrics]
+# The body chunk is only decoded when needed, so lazy songs can be loaded
+# from the header alone.
+
+from collections import OrderedDict
+import decimal
+import marshal
+import mmap
+import os
+import struct
+
+from blitzloop import song, util
+
+MAGIC = b"BLZC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+
+def compiled_path(path):
+    return path + "c"
+
+def source_key(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+def _enc_time(t):
+    if isinstance(t, decimal.Decimal):
+        return str(t)
+    elif isinstance(t, song.MixedFraction):
+        return (t.numerator, t.denominator)
+    return t
+
+def _dec_time(t):
+    if isinstance(t, str):
+        return decimal.Decimal(t)
+    elif isinstance(t, tuple):
+        return song.MixedFraction(*t)
+    return t
+
+def _enc_compound(compound):
+    molecules = []
+    for tag, molecule in compound.items():
+        atoms = []
+        for atom in molecule.atoms:
+            particles = None
+            if atom.particles is not None:
+                particles = [p.text for p in atom.particles]
+            atoms.append((atom.text, atom.particle_edge, atom.particle_edge_l,
+                          particles))
+        molecules.append((tag, molecule.source, molecule.break_before,
+                          molecule.break_after, molecule.row, atoms))
+    timing = None
+    step_times = None
+    if compound.timing is not None:
+        timing = [_enc_time(t) for t in compound.timing]
+    if compound.is_timed:
+        step_times = compound.get_step_times()
+    return (_enc_time(compound.start), timing, step_times, molecules)
+
+def _dec_compound(data, formats, song_timing):
+    start, timing, step_times, molecules = data
+    compound = song.Compound(song_timing)
+    compound.start = _dec_time(start)
+    if timing is not None:
+        compound.timing = [_dec_time(t) for t in timing]
+    if step_times is not None:
+        compound.set_step_times(step_times)
+    for tag, source, break_before, break_after, row, atoms in molecules:
+        cls = formats[tag]
+        molecule = cls.__new__(cls)
+        molecule.source = source
+        molecule.break_before = break_before
+        molecule.break_after = break_after
+        molecule.row = row
+        molecule.atoms = []
+        for text, particle_edge, particle_edge_l, particles in atoms:
+            atom = song.Atom(text)
+            atom.particle_edge = particle_edge
+            atom.particle_edge_l = particle_edge_l
+            if particles is not None:
+                atom.particles = [song.Particle(p) for p in particles]
+            molecule.atoms.append(atom)
+        compound[tag] = molecule
+    return compound
+
+def compile_song(s, key):
+    header = {
+        "source": key,
+        "meta": [(k, list(v.items())) for k, v in s.meta.items()],
+        "song": list(s.song.items()),
+        "timing": s.timing.beats if s.timing is not None else None,
+        "formats": [(tag, song.I_FORMATS[fmt]) for tag, fmt in s.formats.items()],
+    }
+    body = {
+        "styles": [(k, list(v.data.items())) for k, v in s.styles.items()],
+        "variants": [(k, list(v.data.items())) for k, v in s.variants.items()],
+        "compounds": [_enc_compound(c) for c in s.compounds],
+    }
+    header = marshal.dumps(header)
+    body = marshal.dumps(body)
+    return (HEADER.pack(MAGIC, VERSION, marshal.version, len(header), len(body))
+            + header + body)
+
+def _read_chunk(path, which, key=None):
+    with open(path, "rb") as fd:
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < HEADER.size:
+                return None
+            magic, version, mversion, hlen, blen = HEADER.unpack_from(mm)
+            if (magic != MAGIC or version != VERSION or
+                mversion != marshal.version or
+                len(mm) != HEADER.size + hlen + blen):
+                return None
+            off = HEADER.size
+            if which == "body":
+                off += hlen
+            with memoryview(mm) as view:
+                with view[off:off + (hlen if which == "header" else blen)] as chunk:
+                    data = marshal.loads(chunk)
+    if which == "header" and key is not None and tuple(data["source"]) != key:
+        return None
+    return data
+
+class CompiledSong(song.Song):
+    def parse_body(self):
+        data = _read_chunk(self.compiled, "body")
+        if data is None:
+            raise song.ParseError("%s: compiled song is unreadable" % self.compiled)
+        return self.decode_body(data)
+
+    def decode_body(self, data):
+        body = {}
+        body["styles"] = OrderedDict((name, song.Style(OrderedDict(d)))
+                                     for name, d in data["styles"])
+        body["variants"] = OrderedDict((name, song.Variant(OrderedDict(d)))
+                                       for name, d in data["variants"])
+        if body["variants"] and body["styles"]:
+            for variant in body["variants"].values():
+                variant.load_tags(body["styles"])
+        body["compounds"] = [_dec_compound(c, self.formats, self.timing)
+                             for c in data["compounds"]]
+        return body
+
+def load(path, lazy=False, key=None):
+    """
+    Load the compiled version of the .blitz file at path. Returns None if it
+    does not exist, is not readable by this version, or (if key is given) was
+    compiled from a different version of the source file.
+    """
+    cpath = compiled_path(path)
+    try:
+        header = _read_chunk(cpath, "header", key)
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    if header is None:
+        return None
+
+    s = CompiledSong()
+    s.filename = path
+    s.compiled = cpath
+    s.pathbase = os.path.dirname(path)
+    for k, values in header["meta"]:
+        s.meta[k] = song.MultiString(values)
+    s.song.update(header["song"])
+    if header["timing"] is None:
+        s.timing = None
+    else:
+        for time, beat in header["timing"]:
+            s.timing.add(time, beat)
+    for tag, fmt in header["formats"]:
+        s.formats[tag] = song.FORMATS[fmt]
+
+    if lazy:
+        s._body = None
+    else:
+        s._body = s.parse_body()
+    return s
+
+def load_if_fresh(path, lazy=False):
+    try:
+        key = source_key(path)
+    except OSError:
+        return None
+    return load(path, lazy, key)
+
+def save(s, path):
+    data = compile_song(s, source_key(path))
+    cpath = compiled_path(path)
+    tmp = cpath + ".tmp"
+    with open(tmp, "wb") as fd:
+        fd.write(data)
+    os.replace(tmp, cpath)
+
+def compile_file(path, force=False):
+    if not force and load_if_fresh(path, lazy=True) is not None:
+        return False
+    save(song.Song(path), path)
+    return True
+
+def entry():
+    parser = util.get_argparser()
+    parser.add_argument(
+        'paths', metavar='PATH', nargs='+',
+        help='song files, or directories to search for song files')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='recompile even if the compiled song is up to date')
+    opts = util.get_opts()
+
+    for path in opts.paths:
+        if os.path.isdir(path):
+            files = []
+            for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+                files += [os.path.join(dirpath, name) for name in filenames
+                          if name.endswith(".blitz")]
+        else:
+            files = [path]
+        for fn in sorted(files):
+            try:
+                if compile_file(fn, opts.force):
+                    print("Compiled %s" % fn)
+            except (song.ParseError, OSError) as e:
+                print("Failed to compile %s: %s" % (fn, e))
+
+if __name__ == '__main__':
+    entry()
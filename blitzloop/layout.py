@@ -16,30 +16,116 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import array
+import bisect
+import concurrent.futures
+import hashlib
+import os
+import pickle
+import threading
+
 import numpy as np
 
 from blitzloop import song, texture_font
-from blitzloop.util import map_from, map_to
+from blitzloop.util import map_from, map_to, get_opts
 from blitzloop.graphics import get_renderer
 
-class GlyphInstance(object):
-    def __init__(self, glyph, x, y, style):
-        self.glyph = glyph
-        self.x = x
-        self.y = y
-        self.tx1 = self.tx2 = 0
-        self.t1 = self.t2 = 0
-        self.colors = style.colors
-        self.colors_on = style.colors_on
-
-    def set_timing(self, tx1, tx2, t1, t2):
-        self.tx1 = tx1
-        self.tx2 = tx2
-        self.t1 = t1
-        self.t2 = t2
-
-    def __repr__(self):
-        return "Gl(%.04f,%.04f)" % (self.x, self.y)
+class GlyphStore(object):
+    """
+    The glyphs of a DisplayLine, stored as columns: pen position, the timing
+    map (tx1 -> t1, tx2 -> t2), and indices into tables of the font glyphs
+    and of the (colors, colors_on) palettes, which many glyphs share. The
+    renderer reads the columns as NumPy arrays.
+    """
+    COLUMNS = ("x", "y", "tx1", "tx2", "t1", "t2")
+    ARRAYS = COLUMNS + ("glyph_id", "palette_id")
+
+    def __init__(self):
+        for name in self.COLUMNS:
+            setattr(self, name, array.array("d"))
+        self.glyph_id = array.array("q")
+        self.palette_id = array.array("q")
+        self.glyph_table = []
+        self.palette_table = []
+        self._glyph_ids = {}
+        self._palette_ids = {}
+
+    def __len__(self):
+        return len(self.x)
+
+    def copy(self):
+        store = GlyphStore()
+        store.load(self.glyph_table, self.palette_table,
+                   [getattr(self, name) for name in self.ARRAYS])
+        return store
+
+    def load(self, glyph_table, palette_table, arrays):
+        for name, column in zip(self.ARRAYS, arrays):
+            setattr(self, name, array.array(column.typecode, column))
+        self.glyph_table = list(glyph_table)
+        self.palette_table = list(palette_table)
+        self._glyph_ids = {id(glyph): i for i, glyph in enumerate(self.glyph_table)}
+        self._palette_ids = {palette: i for i, palette in enumerate(self.palette_table)}
+
+    def append(self, glyph, x, y, style):
+        gid = self._glyph_ids.get(id(glyph))
+        if gid is None:
+            gid = self._glyph_ids[id(glyph)] = len(self.glyph_table)
+            self.glyph_table.append(glyph)
+        palette = style.colors, style.colors_on
+        pid = self._palette_ids.get(palette)
+        if pid is None:
+            pid = self._palette_ids[palette] = len(self.palette_table)
+            self.palette_table.append(palette)
+        self.glyph_id.append(gid)
+        self.palette_id.append(pid)
+        self.x.append(x)
+        self.y.append(y)
+        for column in (self.tx1, self.tx2, self.t1, self.t2):
+            column.append(0)
+
+    def set_timing(self, first, last, tx1, tx2, t1, t2):
+        for i in range(first, last):
+            self.tx1[i] = tx1
+            self.tx2[i] = tx2
+            self.t1[i] = t1
+            self.t2[i] = t2
+
+    def shift(self, first, dx):
+        for column in (self.tx1, self.tx2, self.x):
+            for i in range(first, len(column)):
+                column[i] += dx
+
+    def column(self, name):
+        return np.frombuffer(getattr(self, name), getattr(self, name).typecode)
+
+class LayoutGeometry(object):
+    """
+    The display size a layout is made for. Layouts take a snapshot instead
+    of reading the display, whose size changes with each song's aspect and
+    may be changed by the render thread while a layout is being prefetched.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def of(cls, display):
+        return cls(display.width, display.height)
+
+    def round_coord(self, c):
+        return int(round(c * self.width)) / self.width
+
+    @property
+    def top(self):
+        return self.height / self.width
+
+    def __eq__(self, other):
+        return (isinstance(other, LayoutGeometry) and
+                (self.width, self.height) == (other.width, other.height))
+
+    def __hash__(self):
+        return hash((self.width, self.height))
 
 class MoleculeInstance(object):
     def __init__(self, molecule, get_atom_time, style, font, ruby_font):
@@ -50,9 +136,10 @@ class MoleculeInstance(object):
         self.ruby_font = ruby_font
 
 class DisplayLine(object):
-    def __init__(self, display):
+    def __init__(self, display, geometry=None):
         self.display = display
-        self.glyphs = []
+        self.geometry = geometry if geometry is not None else LayoutGeometry.of(display)
+        self.glyphs = GlyphStore()
         self.text = ""
         self.px = 0
         self.py = 0
@@ -84,9 +171,9 @@ class DisplayLine(object):
         self.want_row = None
 
     def copy(self):
-        l = DisplayLine(self.display)
+        l = DisplayLine(self.display, self.geometry)
         l.text = self.text
-        l.glyphs = list(self.glyphs)
+        l.glyphs = self.glyphs.copy()
         l.px = self.px
         l.py = self.py
         l.align = self.align
@@ -122,6 +209,55 @@ class DisplayLine(object):
     def lim_end(self):
         return self._end_t + self.layout_options["fade_out"]
 
+    def measure(self, molecule, font, ruby_font):
+        """
+        Returns the width the line would have after add(), without adding
+        anything. Follows the pen arithmetic of add() exactly, so wrapping
+        decisions are the same as adding to a copy.
+        """
+        px = self.px
+        if self.glyphs:
+            px += font.get_glyph(molecule.SPACE).dx
+        prev_char = None
+        for atom in molecule.atoms:
+            atom_x = px
+            edge_px = None
+            edge_l_px = None
+            for i,c in enumerate(atom.text):
+                if atom.particle_edge is not None and i == atom.particle_edge:
+                    edge_px = px
+                if atom.particle_edge_l is not None and i == atom.particle_edge_l:
+                    edge_l_px = px
+                if prev_char is not None:
+                    px += font.get_kerning(prev_char, c)[0]
+                px += font.get_glyph(c).dx
+                prev_char = c
+            if (atom.particles is None or not ruby_font or
+                self.layout_options["ruby_expand"] != 1):
+                continue
+            ruby_px = 0
+            ruby_prev_char = None
+            for particle in atom.particles:
+                for c in particle.text:
+                    if ruby_prev_char is not None:
+                        ruby_px += ruby_font.get_kerning(ruby_prev_char, c)[0]
+                    ruby_px += ruby_font.get_glyph(c).dx
+                    ruby_prev_char = c
+            atom_x_edge = atom_x
+            if edge_l_px is not None:
+                atom_x_edge = edge_l_px
+            if edge_px is not None:
+                atom_width = edge_px - atom_x_edge
+            else:
+                atom_width = px - atom_x_edge
+            dx = self.geometry.round_coord(atom_x_edge + (atom_width - ruby_px) / 2.0)
+            if dx < atom_x:
+                px += atom_x - dx
+                dx = atom_x
+            if dx + ruby_px > px:
+                px = dx + ruby_px
+        return px
+
     def add(self, molecule, get_atom_time, style, font, ruby_font):
         mol = MoleculeInstance(molecule, get_atom_time, style, font, ruby_font)
         self.molecules.append(mol)
@@ -144,12 +280,12 @@ class DisplayLine(object):
         self.descender = min(self.descender, font.descender)
 
         # add the molecule's atoms
+        glyphs = self.glyphs
         for atom in molecule.atoms:
             atom_x, atom_y = self.px, self.py
             edge_px = None
             edge_l_px = None
-            glyphs = []
-            first_glyph = len(self.glyphs)
+            first_glyph = len(glyphs)
             # add the atom's base text as glyphs
             for i,c in enumerate(atom.text):
                 if atom.particle_edge is not None and i == atom.particle_edge:
@@ -158,19 +294,18 @@ class DisplayLine(object):
                     edge_l_px = self.px
                 self.text += c
                 glyph = font.get_glyph(c)
-                gi = GlyphInstance(glyph, self.px, self.py, style)
+                glyphs.append(glyph, self.px, self.py, style)
                 if prev_char is not None:
                     kx, ky = font.get_kerning(prev_char, c)
                     self.px += kx
                     self.py += ky
-                glyphs.append(gi)
                 self.px += glyph.dx
                 self.py += glyph.dy
                 prev_char = c
             # assign the timing map for the atom's glyphs
             # atom_x (left) -> atom start time
             # self.px (right) -> atom end time
-            for glyph in glyphs:
+            if len(glyphs) > first_glyph:
                 start, end = get_atom_time(step, atom.steps)
                 if self._start_t is None:
                     self._start_t = start
@@ -180,37 +315,34 @@ class DisplayLine(object):
                     self._end_t = end
                 else:
                     self._end_t = max(end, self._end_t)
-                glyph.set_timing(atom_x, self.px, start, end)
-            self.glyphs += glyphs
+                glyphs.set_timing(first_glyph, len(glyphs), atom_x, self.px, start, end)
             # if the atom has subatomic particles (ruby text)
             if atom.particles is not None and ruby_font:
                 # ruby pen. we will adjust X later when centering over atom.
                 ruby_px = 0
-                ruby_py = self.display.round_coord(atom_y + font.ascender - ruby_font.descender + ruby_spacing)
+                ruby_py = self.geometry.round_coord(atom_y + font.ascender - ruby_font.descender + ruby_spacing)
                 ruby_prev_char = None
-                ruby_glyphs = []
+                first_ruby = len(glyphs)
                 par_step = step
                 # add the particles
                 for particle in atom.particles:
-                    par_glyphs = []
+                    first_par = len(glyphs)
                     particle_x = ruby_px
                     # add the characters in the particle
                     for c in particle.text:
                         glyph = ruby_font.get_glyph(c)
-                        gi = GlyphInstance(glyph, ruby_px, ruby_py, style)
+                        glyphs.append(glyph, ruby_px, ruby_py, style)
                         if ruby_prev_char is not None:
                             kx, ky = ruby_font.get_kerning(ruby_prev_char, c)
                             ruby_px += kx
                             ruby_py += ky
-                        par_glyphs.append(gi)
                         ruby_px += glyph.dx
                         ruby_py += glyph.dy
                         ruby_prev_char = c
-                    for glyph in par_glyphs:
+                    if len(glyphs) > first_par:
                         start, end = get_atom_time(par_step, particle.steps)
-                        glyph.set_timing(particle_x, ruby_px, start, end)
+                        glyphs.set_timing(first_par, len(glyphs), particle_x, ruby_px, start, end)
                     par_step += particle.steps
-                    ruby_glyphs += par_glyphs
                 # center the ruby text over the atom
                 atom_x_edge = atom_x
                 if edge_l_px is not None:
@@ -219,18 +351,11 @@ class DisplayLine(object):
                     atom_width = edge_px - atom_x_edge
                 else:
                     atom_width = self.px - atom_x_edge
-                dx = self.display.round_coord(atom_x_edge + (atom_width - ruby_px) / 2.0)
-                for glyph in ruby_glyphs:
-                    glyph.tx1 += dx
-                    glyph.tx2 += dx
-                    glyph.x += dx
-                    self.glyphs.append(glyph)
+                dx = self.geometry.round_coord(atom_x_edge + (atom_width - ruby_px) / 2.0)
+                glyphs.shift(first_ruby, dx)
                 if self.layout_options["ruby_expand"] == 1:
                     if dx < atom_x:
-                        for glyph in self.glyphs[first_glyph:]:
-                            glyph.tx1 += atom_x - dx
-                            glyph.tx2 += atom_x - dx
-                            glyph.x += atom_x - dx
+                        glyphs.shift(first_glyph, atom_x - dx)
                         self.px += atom_x - dx
                         dx = atom_x
                     if dx + ruby_px > self.px:
@@ -254,20 +379,241 @@ class DisplayLine(object):
     def __str__(self):
         return "DisplayLine<[%s]>" % self.text
 
+class LineIndex(object):
+    """
+    Finds the lines with start <= t <= end. Playback moves forward, so the
+    active set is kept between calls and only lines starting since the last
+    call are added; going backwards bisects the start-sorted lines instead.
+    Lines are returned in the order they were given in.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.order = sorted(range(len(lines)), key=lambda i: lines[i].start)
+        self.starts = [lines[i].start for i in self.order]
+        self.max_len = max([l.end - l.start for l in lines] or [0])
+        self.t = None
+        self.cursor = 0
+        self.active = []
+
+    def visible(self, t):
+        lines = self.lines
+        if self.t is None or t < self.t:
+            lo = bisect.bisect_left(self.starts, t - self.max_len)
+            self.cursor = lo
+            self.active = []
+        self.t = t
+        added = False
+        while self.cursor < len(self.starts) and self.starts[self.cursor] <= t:
+            self.active.append(self.order[self.cursor])
+            self.cursor += 1
+            added = True
+        self.active = [i for i in self.active if lines[i].end >= t]
+        if added:
+            self.active.sort()
+        return [lines[i] for i in self.active]
+
+class LineRow(object):
+    """
+    The lines in one layout row, sorted by start time (ties in insertion
+    order). Lines in a row do not normally overlap, so the lines colliding
+    with a new one are found by bisecting on start and scanning back only
+    over the overlapping ones.
+    """
+    def __init__(self):
+        self.lines = []
+        self.starts = []
+        self.index = None
+
+    def add(self, l):
+        i = bisect.bisect_right(self.starts, l.start)
+        self.lines.insert(i, l)
+        self.starts.insert(i, l.start)
+        self.index = None
+
+    def remove(self, l):
+        i = self.lines.index(l, bisect.bisect_left(self.starts, l.start))
+        del self.lines[i]
+        del self.starts[i]
+        self.index = None
+
+    def collides(self, l):
+        """
+        The lines overlapping l, latest first. Stops at the first line that
+        ends before l starts.
+        """
+        c = []
+        if l.start < l.end:
+            # lines starting at or after l.end cannot overlap it
+            end = bisect.bisect_left(self.starts, l.end)
+        else:
+            end = len(self.lines)
+        for i in range(end - 1, -1, -1):
+            l2 = self.lines[i]
+            if l.start >= l2.end:
+                break
+            elif l.end <= l2.start:
+                continue
+            else:
+                c.append(l2)
+        return c
+
+    def prev(self, l):
+        """
+        The line before l in the row, or None.
+        """
+        if self.index is None:
+            self.index = {id(l2): i for i, l2 in enumerate(self.lines)}
+        i = self.index[id(l)]
+        return self.lines[i - 1] if i > 0 else None
+
+class LayoutCache(object):
+    """
+    Laid out lines by song file, variant, fonts and display geometry, stored
+    on disk with one file per layout if directory is set. put() only queues
+    the layout; save() writes the queued ones, away from the render thread.
+    """
+    VERSION = 2
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".layout")
+
+    def get(self, key):
+        if not self.directory or key is None:
+            return None
+        path = self._path(key)
+        with self.lock:
+            entry = self.pending.get(path)
+        if entry is not None:
+            return entry[1] if entry[0] == key else None
+        try:
+            with open(path, "rb") as fd:
+                version, file_key, data = pickle.load(fd)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Layout cache %s unusable, ignoring: %r" % (path, e))
+            return None
+        if version != self.VERSION or file_key != key:
+            return None
+        return data
+
+    def put(self, key, data):
+        if not self.directory or key is None:
+            return
+        with self.lock:
+            self.pending[self._path(key)] = key, data
+
+    def save(self):
+        with self.lock:
+            pending = list(self.pending.items())
+            self.pending.clear()
+        if not self.directory:
+            return
+        for path, (key, data) in pending:
+            tmp = "%s.%d.tmp" % (path, threading.get_ident())
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(tmp, "wb") as fd:
+                    pickle.dump((self.VERSION, key, data), fd,
+                                pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except OSError as e:
+                print("Failed to write layout cache %s: %r" % (path, e))
+
+layout_cache = LayoutCache()
+
 class SongLayout(object):
-    def __init__(self, song_obj, variant, renderer):
+    LINE_FIELDS = (
+        "text", "px", "py", "align", "x", "y", "min_px", "max_px", "_start_t",
+        "_end_t", "start", "end", "ascender", "descender", "want_row", "row",
+        "layout_options",
+    )
+
+    def __init__(self, song_obj, variant, renderer, atlas=None, build=True,
+                 cache=layout_cache, geometry=None):
         self.song = song_obj
+        self.variant_name = variant
         self.variant = song_obj.variants[variant]
         self.renderer = renderer
+        if geometry is None:
+            geometry = LayoutGeometry.of(renderer.display)
+        self.geometry = geometry
+        self.atlas = atlas if atlas is not None else renderer.atlas
 
         self.lines = {}
         self.fonts = {}
+        self.rlayout = None
+
+        self.song.precompute_timing()
+        self._render_glyphs()
+        key = self._cache_key() if cache is not None else None
+        data = cache.get(key) if key is not None else None
+        if data is not None:
+            self._load_lines(data)
+        else:
+            self._prebuild_kerning()
+            self._merge_lines()
+            self._layout_lines(self.lines[song.TagInfo.BOTTOM], False)
+            self._layout_lines(self.lines[song.TagInfo.TOP], True)
+            if key is not None:
+                cache.put(key, self._save_lines())
+        self.line_index = LineIndex([l for lines in self.lines.values()
+                                     for l in lines])
+        if build:
+            self.build()
 
-        self._merge_lines()
-        self._layout_lines(self.lines[song.TagInfo.BOTTOM], False)
-        self._layout_lines(self.lines[song.TagInfo.TOP], True)
+    def build(self):
+        # Everything up to here is plain Python and NumPy, this part talks to
+        # GL and must run on the render thread.
         self._build_lines()
-        self.renderer.atlas.upload()
+        self.atlas.upload()
+
+    def _cache_key(self):
+        # The layout only depends on the song file, the variant, the fonts
+        # (whose cache_ident covers the glyph resolution) and the geometry,
+        # so this is enough to identify it.
+        if not self.song.filename:
+            return None
+        try:
+            st = os.stat(self.song.filename)
+        except OSError:
+            return None
+        fonts = sorted(font.cache_ident for font in self.fonts.values())
+        return (os.path.abspath(self.song.filename), st.st_mtime_ns,
+                st.st_size, self.variant_name, self.geometry.width,
+                self.geometry.height, fonts)
+
+    def _save_lines(self):
+        glyph_ids = {}
+        for ident, font in self.fonts.items():
+            for c, glyph in font.glyphs.items():
+                glyph_ids[id(glyph)] = (ident, c)
+        data = {}
+        for edge, lines in self.lines.items():
+            data[edge] = [(
+                tuple(getattr(l, f) for f in self.LINE_FIELDS),
+                [glyph_ids[id(glyph)] for glyph in l.glyphs.glyph_table],
+                l.glyphs.palette_table,
+                [getattr(l.glyphs, name) for name in GlyphStore.ARRAYS],
+            ) for l in lines]
+        return data
+
+    def _load_lines(self, data):
+        for edge, lines in data.items():
+            self.lines[edge] = []
+            for fields, glyph_table, palette_table, arrays in lines:
+                l = DisplayLine(self.renderer.display, self.geometry)
+                for f, value in zip(self.LINE_FIELDS, fields):
+                    setattr(l, f, value)
+                l.glyphs.load([self.fonts[ident].glyphs[c] for ident, c in glyph_table],
+                              palette_table, arrays)
+                self.lines[edge].append(l)
 
     def _get_font(self, style, ruby=False):
         font = style.font if not ruby else style.ruby_font
@@ -279,10 +625,83 @@ class SongLayout(object):
             return self.fonts[ident]
         else:
             fontfile = self.song.get_font_path(font)
-            font = texture_font.TextureFont(self.renderer.display.width, self.renderer.atlas, fontfile, size, style)
+            glyphclass = texture_font.OutlinedGlyph
+            if get_opts().sdf_glyphs:
+                glyphclass = texture_font.SDFGlyph
+            font = texture_font.TextureFont(self.geometry.width, self.atlas, fontfile, size, style, glyphclass)
             self.fonts[ident] = font
             return font
 
+    def _render_glyphs(self):
+        # Render all glyphs the variant needs up front, in parallel. FreeType
+        # releases the GIL, so threads are enough.
+        chars = {}
+        for compound in self.song.compounds:
+            for tag, molecule in compound.items():
+                if tag not in self.variant.tags:
+                    continue
+                style = self.variant.tags[tag].style
+                text = chars.setdefault(self._get_font(style, False), {})
+                ruby_font = None
+                if molecule.has_ruby:
+                    ruby_font = self._get_font(style, True)
+                for atom in molecule.atoms:
+                    text.update(dict.fromkeys(atom.text))
+                    if atom.particles is not None and ruby_font:
+                        ruby_text = chars.setdefault(ruby_font, {})
+                        for particle in atom.particles:
+                            ruby_text.update(dict.fromkeys(particle.text))
+
+        missing = [(font, c) for font, text in chars.items()
+                   for c in font.missing_glyphs(text)]
+        workers = get_opts().glyph_workers or os.cpu_count() or 1
+        if workers < 2 or len(missing) < 2:
+            rendered = [font.render_glyph(c) for font, c in missing]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                rendered = list(executor.map(
+                    lambda fc: fc[0].render_glyph(fc[1], threaded=True), missing))
+        rendered = dict(zip(missing, rendered))
+
+        # Pack the whole glyph set into the atlas at once
+        glyphs = []
+        for font, text in chars.items():
+            for c in text:
+                if c in font.glyphs:
+                    continue
+                glyph = rendered.get((font, c))
+                if glyph is None and font.cache is not None:
+                    glyph = font.cache.get(font.cache_ident, c)
+                if glyph is None:
+                    glyph = font.render_glyph(c)
+                glyphs.append((font, c, glyph))
+        texture_font.add_glyphs(self.atlas, glyphs)
+
+    def _prebuild_kerning(self):
+        # Look up every character pair that add() will kern in one go, so
+        # each distinct pair reaches FreeType at most once
+        pairs = {}
+        for compound in self.song.compounds:
+            for tag, molecule in compound.items():
+                if tag not in self.variant.tags:
+                    continue
+                style = self.variant.tags[tag].style
+                text = "".join(atom.text for atom in molecule.atoms)
+                pairs.setdefault(self._get_font(style, False), set()).update(
+                    zip(text, text[1:]))
+                ruby_font = None
+                if molecule.has_ruby:
+                    ruby_font = self._get_font(style, True)
+                if not ruby_font:
+                    continue
+                for atom in molecule.atoms:
+                    if atom.particles is not None:
+                        text = "".join(particle.text for particle in atom.particles)
+                        pairs.setdefault(ruby_font, set()).update(
+                            zip(text, text[1:]))
+        for font, font_pairs in pairs.items():
+            font.prebuild_kerning(font_pairs)
+
     def _merge_lines(self):
         edges = {
             song.TagInfo.TOP: [],
@@ -304,53 +723,43 @@ class SongLayout(object):
                 else:
                     ruby_font = None
                 if molecule.break_before or line is None:
-                    line = DisplayLine(self.renderer.display)
+                    line = DisplayLine(self.renderer.display, self.geometry)
                     line.layout_options.update(tag_info.layout_options)
                     line.add(molecule, get_atom_time, tag_info.style, font, ruby_font)
                     lines.append(line)
                     if molecule.row is not None:
                         line.want_row = molecule.row
                 else:
-                    tmp = line.copy()
-                    tmp.add(molecule, get_atom_time, tag_info.style, font, ruby_font)
                     wrapwidth = 1.0 - 2 * line.layout_options["margin_x"]
-                    if tmp.px > wrapwidth:
-                        line = DisplayLine(self.renderer.display)
+                    if line.measure(molecule, font, ruby_font) > wrapwidth:
+                        line = DisplayLine(self.renderer.display, self.geometry)
                         line.layout_options.update(tag_info.layout_options)
-                        line.add(molecule, get_atom_time, tag_info.style, font, ruby_font)
                         lines.append(line)
-                    else:
-                        lines[-1] = line = tmp
+                    line.add(molecule, get_atom_time, tag_info.style, font, ruby_font)
                 if molecule.break_after:
                     line = None
 
             self.lines[edge] = lines
 
     def _build_lines(self):
-        for lines in self.lines.values():
-            for dl in lines:
-                dl.build()
+        if get_opts().no_batching:
+            self.rlayout = None
+            for lines in self.lines.values():
+                for dl in lines:
+                    dl.build()
+        else:
+            lines = [dl for lines in self.lines.values() for dl in lines]
+            self.rlayout = get_renderer().RenderedLayout(lines)
+            self.rlayout.build()
 
     def _layout_lines(self, lines, top=False):
         if not lines:
             return
-        rows = [[] for i in range(10)]
+        rows = [LineRow() for i in range(10)]
         lines.sort(key = lambda x: x.start)
 
-        def sortrow(rowid):
-            rows[rowid].sort(key = lambda x: x.start)
-
         def collides(l, rowid):
-            c = []
-            for l2 in rows[rowid][::-1]:
-                if l.start >= l2.end:
-                    return c
-                elif l.end <= l2.start:
-                    continue
-                else:
-                    c.append(l2)
-            else:
-                return c
+            return rows[rowid].collides(l)
 
         def canmoveup(l, limit=1):
             if l.row >= limit:
@@ -365,11 +774,9 @@ class SongLayout(object):
             for l2 in collides(l, l.row + 1):
                 moveup(l2, limit)
             rows[l.row].remove(l)
-            sortrow(l.row)
             l.row += 1
             assert not collides(l, l.row)
-            rows[l.row].append(l)
-            sortrow(l.row)
+            rows[l.row].add(l)
 
         def canmovetop(l):
             return True
@@ -386,35 +793,33 @@ class SongLayout(object):
                     for l2 in collides(l, need_row):
                         movetop(l2)
                 rows[l.row].remove(l)
-                sortrow(l.row)
                 l.row = need_row
-                rows[l.row].append(l)
-                sortrow(l.row)
+                rows[l.row].add(l)
 
         if not top:
             for i, l in enumerate(lines):
                 if l.want_row is not None and not collides(l, l.want_row):
                     l.row = l.want_row
-                    rows[l.want_row].append(l)
+                    rows[l.want_row].add(l)
                 elif not collides(l, 1):
                     l.row = 1
-                    rows[1].append(l)
+                    rows[1].add(l)
                 elif not collides(l, 0):
                     l.row = 0
-                    rows[0].append(l)
+                    rows[0].add(l)
                 else:
                     need_row = 2
                     while collides(l, need_row):
                         need_row += 1
                     for want_row in (lines[i-1].row,):
-                        if canmoveup(rows[want_row][-1], need_row):
-                            moveup(rows[want_row][-1], need_row)
+                        if canmoveup(rows[want_row].lines[-1], need_row):
+                            moveup(rows[want_row].lines[-1], need_row)
                             l.row = want_row
-                            rows[want_row].append(l)
+                            rows[want_row].add(l)
                             break
                     else:
                         l.row = need_row
-                        rows[need_row].append(l)
+                        rows[need_row].add(l)
         else:
             for i, l in enumerate(lines):
                 for row in range(len(rows)):
@@ -423,17 +828,17 @@ class SongLayout(object):
                         break
                 if i == 0 or need_row <= (lines[i-1].row + 1):
                     l.row = need_row
-                    rows[need_row].append(l)
+                    rows[need_row].add(l)
                 else:
                     for want_row in (lines[i-1].row, lines[i-1].row + 1):
-                        if canmovetop(rows[want_row][-1]):
-                            movetop(rows[want_row][-1])
+                        if canmovetop(rows[want_row].lines[-1]):
+                            movetop(rows[want_row].lines[-1])
                             l.row = want_row
-                            rows[want_row].append(l)
+                            rows[want_row].add(l)
                             break
                     else:
                         l.row = need_row
-                        rows[need_row].append(l)
+                        rows[need_row].add(l)
 
         max_ascender = max(l.ascender for l in lines)
         min_descender = min(l.descender for l in lines)
@@ -465,19 +870,105 @@ class SongLayout(object):
                 l.start = max(min(l.start, prev_l.lim_start), l.start - l.layout_options["early_limit"])
                 if prev_l.row < l.row:
                     l.start = min(orig_start, max(l.start, prev_l.start + l.layout_options["reverse_stagger"]))
-                prev_in_row = rows[l.row].index(l) - 1
-                if prev_in_row >= 0:
-                    l.start = max(l.start, rows[l.row][prev_in_row].end)
+                prev_in_row = rows[l.row].prev(l)
+                if prev_in_row is not None:
+                    l.start = max(l.start, prev_in_row.end)
             max_end = max(max_end, l.end)
             lastrow = l.row
             if not top:
                 l.y = l.layout_options["margin_y"] - min_descender + row_height * l.row
             else:
-                l.y = self.renderer.display.top - l.layout_options["margin_y"] - max_ascender - row_height * l.row
+                l.y = self.geometry.top - l.layout_options["margin_y"] - max_ascender - row_height * l.row
             prev_l = l
 
     def draw(self, t, renderer):
-        for edge, lines in self.lines.items():
-            for l in lines:
-                if l.start <= t <= l.end:
-                    l.draw(renderer)
+        visible = self.line_index.visible(t)
+        if self.rlayout is not None:
+            self.rlayout.draw(renderer, visible)
+        else:
+            for l in visible:
+                l.draw(renderer)
+
+class LayoutPrefetcher(object):
+    """
+    Lays out a song on a background thread into its own atlas, so that only
+    the GL uploads are left to do when it starts playing.
+    """
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.cond = threading.Condition()
+        self.wanted = None
+        self.busy = None
+        self.done = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prefetch(self, song_obj, variant, geometry):
+        """
+        Lays out the given song and variant index for geometry, a
+        LayoutGeometry snapshot taken on the render thread.
+        """
+        key = (song_obj, variant, geometry)
+        with self.cond:
+            if key in (self.wanted, self.busy) or (self.done and self.done[0] == key):
+                return
+            self.wanted = key
+            self.cond.notify_all()
+
+    def get(self, song_obj, variant, geometry):
+        """
+        Returns the unbuilt layout for the given song and variant index (see
+        SongLayout.build), waiting for it if it is being laid out right now,
+        or None if it was not prefetched for this geometry.
+        """
+        key = (song_obj, variant, geometry)
+        with self.cond:
+            if self.wanted is not None and self.wanted[:2] == key[:2]:
+                self.wanted = None
+            while self.busy == key:
+                self.cond.wait()
+            if self.done is not None and self.done[0][:2] == key[:2]:
+                done_key, song_layout = self.done
+                self.done = None
+                if done_key == key:
+                    return song_layout
+                print("Prefetched layout is for another display geometry, discarding")
+        return None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.wanted is None and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                self.busy = key = self.wanted
+                self.wanted = None
+                self.done = None
+            song_obj, variant, geometry = key
+            try:
+                variant_key = list(song_obj.variants.keys())[variant]
+                song_layout = SongLayout(song_obj, variant_key, self.renderer,
+                                         self.renderer.new_atlas(), build=False,
+                                         geometry=geometry)
+            except Exception as e:
+                print("Prefetching layout failed: %r" % e)
+                song_layout = None
+            with self.cond:
+                self.busy = None
+                if song_layout is not None:
+                    self.done = key, song_layout
+                self.cond.notify_all()
+            # Write out new glyphs, kerning and layouts here, off the render
+            # thread, and at most once per prefetched song rather than per
+            # layout.
+            texture_font.glyph_cache.save()
+            layout_cache.save()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
@@ -18,12 +18,16 @@
 
 import os, threading
 
-from blitzloop import graphics, idlescreen, layout, mpvplayer, songlist, util, web
+from blitzloop import graphics, idlescreen, layout, mpvplayer, song, songlist, songwatch, texture_font, util, web
 
 
 def entry():
     data_home = os.getenv('XDG_DATA_HOME', '~/.local/share')
     songs_dir = os.path.join(data_home, 'blitzloop', 'songs')
+    cache_home = os.getenv('XDG_CACHE_HOME', '~/.cache')
+    song_cache = os.path.join(cache_home, 'blitzloop', 'songs.cache')
+    glyph_cache = os.path.join(cache_home, 'blitzloop', 'glyphs')
+    layout_cache = os.path.join(cache_home, 'blitzloop', 'layouts')
 
     def csv_list(s):
         return s.split(",")
@@ -32,6 +36,36 @@ def entry():
     parser.add_argument(
         '--songdir', default=os.path.expanduser(songs_dir),
         help='directory with songs')
+    parser.add_argument(
+        '--song-cache', default=os.path.expanduser(song_cache),
+        help='file to cache parsed songs in (empty to disable)')
+    parser.add_argument(
+        '--glyph-cache-dir', default=os.path.expanduser(glyph_cache),
+        help='directory to cache rendered glyphs in (empty to disable)')
+    parser.add_argument(
+        '--glyph-cache-size', default=32, type=int,
+        help='number of fonts to keep rendered glyphs in memory for')
+    parser.add_argument(
+        '--layout-cache-dir', default=os.path.expanduser(layout_cache),
+        help='directory to cache song layouts in (empty to disable)')
+    parser.add_argument(
+        '--load-workers', default=0, type=int,
+        help='processes used to parse songs at startup (0 = one per CPU)')
+    parser.add_argument(
+        '--lazy-songs', action="store_true",
+        help='only read song headers at startup, load lyrics on demand')
+    parser.add_argument(
+        '--lyrics-cache-size', default=64, type=int,
+        help='number of songs to keep parsed lyrics for with --lazy-songs')
+    parser.add_argument(
+        '--rescan-interval', default=60, type=int,
+        help='seconds between song directory rescans when inotify is not '
+             'available (0 disables picking up song changes while running)')
+    parser.add_argument(
+        '--no-mpv-preload', action="store_true",
+        help='do not open the next song in a second mpv instance while the '
+             'current one plays (needed if the audio device can only be '
+             'opened once)')
     parser.add_argument('--host', default='0.0.0.0', help='IP to listen on')
     parser.add_argument(
         '--port', default=10111, type=int,
@@ -53,9 +87,22 @@ def entry():
     songs_dir = os.path.expanduser(opts.songdir)
 
     print("Loading song DB...")
-    song_database = songlist.SongDatabase(songs_dir)
+    song_cache = os.path.expanduser(opts.song_cache) if opts.song_cache else None
+    song.body_cache.size = opts.lyrics_cache_size
+    texture_font.glyph_cache.size = opts.glyph_cache_size
+    if opts.glyph_cache_dir:
+        texture_font.glyph_cache.directory = os.path.expanduser(opts.glyph_cache_dir)
+    if opts.layout_cache_dir:
+        layout.layout_cache.directory = os.path.expanduser(opts.layout_cache_dir)
+    song_database = songlist.SongDatabase(songs_dir, song_cache,
+                                          opts.load_workers, opts.lazy_songs)
     print("Done.")
 
+    song_watcher = None
+    if opts.rescan_interval > 0:
+        song_watcher = songwatch.SongWatcher(song_database, opts.rescan_interval)
+        song_watcher.start()
+
     display = graphics.Display(opts.width, opts.height, opts.fullscreen)
     renderer = graphics.get_renderer().KaraokeRenderer(display)
     mpv = mpvplayer.Player(display)
@@ -97,6 +144,7 @@ def entry():
     server.start()
 
     idle_screen = idlescreen.IdleScreen(display)
+    prefetcher = layout.LayoutPrefetcher(renderer)
 
     def main_render():
         # Wait for element in queue
@@ -136,10 +184,18 @@ def entry():
         update_params(True)
         mpv.update_mixer(force=True)
 
-        print("Laying out song...")
-        renderer.reset()
-        variant_key = list(qe.song.variants.keys())[qe.variant]
-        song_layout = layout.SongLayout(qe.song, variant_key, renderer)
+        geometry = layout.LayoutGeometry.of(display)
+        song_layout = prefetcher.get(qe.song, qe.variant, geometry)
+        if song_layout is not None:
+            print("Using prefetched layout...")
+            renderer.reset(song_layout.atlas)
+            song_layout.build()
+        else:
+            print("Laying out song...")
+            renderer.reset()
+            variant_key = list(qe.song.variants.keys())[qe.variant]
+            song_layout = layout.SongLayout(qe.song, variant_key, renderer,
+                                            geometry=geometry)
         print("Loaded.")
 
         song_time = -10
@@ -173,6 +229,16 @@ def entry():
 
             update_params()
             audio_config.update(qe.song)
+
+            with queue.lock:
+                next_qe = queue[1] if len(queue) > 1 else None
+            if next_qe is not None:
+                # The next song's aspect is not known until it is loaded, so
+                # guess it matches this one; get() rejects it otherwise
+                prefetcher.prefetch(next_qe.song, next_qe.variant,
+                                    geometry)
+                if not opts.no_mpv_preload:
+                    mpv.preload(next_qe.song)
             yield None
             mpv.flip()
 
@@ -201,6 +267,11 @@ def entry():
         if not opts.no_audioengine:
             audio.shutdown()
         server.stop()
+        prefetcher.stop()
+        texture_font.glyph_cache.save()
+        layout.layout_cache.save()
+        if song_watcher:
+            song_watcher.stop()
         print("Exit handler done")
 
     def key(k):
@@ -24,173 +24,286 @@ from blitzloop import util, graphics
 
 class Player(object):
     MIN_AUDIO_RECONFIGURE_INTERVAL = 0.1
+    PROPERTY_TIMEOUT = 1.0
+    # Seconds the synchronous load paths sleep between loader steps
+    PROPERTY_RETRY_DELAY = 0.1
+    EVENT_RETRY_DELAY = 0.01
+    AF = '@lavfi:lavfi="pan=stereo|c0=c0|c1=c1",@rb:rubberband=pitch=speed'
+
     def __init__(self, display, rendering=False):
         self.last_audio_reconfig = 0
         self.audio_reconfig_pending = False
         self.volume = 0.5
         self.song = None
         self.display = display
-        self.opts = opts = util.get_opts()
-        self.mpv = mpv.Context()
-        self.gl = None
+        self.opts = util.get_opts()
         self.rendering = rendering
-        self.mpv.initialize()
+        self.mpv, self.gl = self._create_context()
+        self.poll_props = {"audio-pts": None,
+                           "time-pos": None}
+        for i in self.poll_props:
+            self.mpv.get_property_async(i)
+
+        # Standby context for preload(): (mpv, gl), the song being loaded
+        # into it, the loader generator while in progress and its result.
+        self.standby = None
+        self.preload_song = None
+        self.preload_failed = None
+        self.preload_job = None
+        self.preload_state = None
+
+        if display:
+            self.solid_renderer = graphics.get_solid_renderer()
+
+    def _create_context(self):
+        opts = self.opts
+        ctx = mpv.Context()
+        ctx.initialize()
         if opts.mpv_msg_level:
-            self.mpv.set_property("msg-level", opts.mpv_msg_level)
-        self.mpv.set_property("audio-file-auto", "no")
-        self.mpv.set_property("terminal", True)
-        self.mpv.set_property("quiet", True)
+            ctx.set_property("msg-level", opts.mpv_msg_level)
+        ctx.set_property("audio-file-auto", "no")
+        ctx.set_property("terminal", True)
+        ctx.set_property("quiet", True)
         if opts.mpv_ao:
-            self.mpv.set_property("ao", opts.mpv_ao)
+            ctx.set_property("ao", opts.mpv_ao)
         elif opts.mpv_audio_device:
-            self.mpv.set_property("audio-device", opts.mpv_audio_device)
-        self.mpv.set_property("fs", True)
+            ctx.set_property("audio-device", opts.mpv_audio_device)
+        ctx.set_property("fs", True)
         if opts.mpv_ao == "jack":
-            self.mpv.set_property("jack-autostart", "yes")
-        self.mpv.set_property("af", '@lavfi:lavfi="pan=stereo|c0=c0|c1=c1",@rb:rubberband=pitch=speed')
+            ctx.set_property("jack-autostart", "yes")
+        ctx.set_property("af", self.AF)
         if opts.mpv_options:
             for opt in shlex.split(opts.mpv_options):
                 if "=" not in opt:
                     key, val = opt, True
                 else:
                     key, val = opt.split("=", 1)
-                self.mpv.set_property(key, val)
-        self.poll_props = {"audio-pts": None,
-                           "time-pos": None}
-        for i in self.poll_props:
-            self.mpv.get_property_async(i)
+                ctx.set_property(key, val)
 
+        gl = None
+        display = self.display
         if display:
             if opts.mpv_hwdec:
-                self.mpv.set_property("hwdec", opts.mpv_hwdec)
+                ctx.set_property("hwdec", opts.mpv_hwdec)
             vo = opts.mpv_vo
             if vo in ("opengl-cb", "libmpv"):
                 vo = "libmpv"
-                if not rendering:
-                    self.mpv.set_property("video-sync", "display-vdrop")
+                if not self.rendering:
+                    ctx.set_property("video-sync", "display-vdrop")
                 else:
-                    self.mpv.set_property("video-sync", "display-desync")
-                self.mpv.set_property("display-fps", display.fps or opts.fps)
+                    ctx.set_property("video-sync", "display-desync")
+                ctx.set_property("display-fps", display.fps or opts.fps)
                 def gpa(name):
                     return display.get_proc_address(name)
-                self.gl = mpv.OpenGLRenderContext(self.mpv, gpa,
-                                                  **display.get_mpv_params())
-            else:
-                self.gl = None
-            self.mpv.set_property("vo", vo)
-            self.solid_renderer = graphics.get_solid_renderer()
+                gl = mpv.OpenGLRenderContext(ctx, gpa,
+                                             **display.get_mpv_params())
+            ctx.set_property("vo", vo)
         else:
-            self.gl = None
-            self.mpv.set_property("vo", "null")
-            self.mpv.set_property("vid", "no")
-
+            ctx.set_property("vo", "null")
+            ctx.set_property("vid", "no")
+        return ctx, gl
 
-    def load_song(self, song):
-        self.song = song
-        self.fadevol = 1
-        self.fade_in = 1
-        self.fade_out = 1
-        self.speed = 1
-        self.pause = False
-        self.pitch = 1
-        self.offset = 0
-        self.song_time = None
-        if "fade_in" in song.song:
-            self.fade_in = float(song.song["fade_in"])
-        if "fade_out" in song.song:
-            self.fade_out = float(song.song["fade_out"])
+    def _drain(self, ctx):
+        evs = []
+        while True:
+            ev = ctx.wait_event(0)
+            if ev.id == mpv.Events.none:
+                return evs
+            evs.append(ev)
+
+    def _loader(self, ctx, events, song):
+        """
+        Load song into the mpv context ctx, yielding whenever it has to wait
+        for mpv (the value is how long a synchronous caller should sleep
+        before resuming). events is called to fetch pending events from ctx.
+        Returns the player state to apply once the song becomes the current
+        one.
+        """
+        st = {}
+
+        # A recycled standby context may still be playing or loading
+        ctx.set_property("pause", True)
+        events()
+        if not ctx.get_property("idle-active"):
+            ctx.command('stop')
+            yield from self._wait_ev(events, mpv.Events.idle)
+
+        ctx.set_property("speed", 1.0)
+        ctx.set_property("af", self.AF)
 
-        self.set_pause(True)
         # Load just the audio first to find out the duration lower bound
-        self.mpv.set_property("audio-files", [])
-        self.poll()
-        self.eof = False
-        self.mpv.set_property("vid", "auto")
-        self.mpv.command('loadfile', song.audiofile)
-        self._wait_ev(mpv.Events.file_loaded)
-        self.duration = self._getprop("duration")
-
-        self.mpv.set_property("keepaspect", True)
-        self.mpv.set_property("lavfi-complex", "")
-        self.mpv.set_property("brightness", 0)
-        self.mpv.set_property("audio-delay", 0)
-        self.mpv.set_property("vf", "")
+        ctx.set_property("audio-files", [])
+        ctx.set_property("vid", "auto")
+        ctx.command('loadfile', song.audiofile)
+        yield from self._wait_ev(events, mpv.Events.file_loaded)
+        st["duration"] = yield from self._getprop(ctx, events, "duration")
+
+        ctx.set_property("keepaspect", True)
+        ctx.set_property("lavfi-complex", "")
+        ctx.set_property("brightness", 0)
+        ctx.set_property("audio-delay", 0)
+        ctx.set_property("vf", "")
 
         # Fix seek behavior when using a static background
         if any(song.videofile.endswith(e) for e in [".jpg", ".png", ".bmp"]):
-            self.mpv.set_property("hr-seek", "yes")
+            ctx.set_property("hr-seek", "yes")
 
+        st["offset"] = 0
         if "video_offset" in song.song:
-            self.offset = float(song.song["video_offset"])
-            self.mpv.set_property("audio-delay", self.offset)
+            st["offset"] = float(song.song["video_offset"])
+            ctx.set_property("audio-delay", st["offset"])
         if song.videofile is not None and song.audiofile != song.videofile:
-            self.mpv.set_property("audio-files", [song.audiofile])
-            self.mpv.command('stop')
-            self._wait_ev(mpv.Events.idle)
-            self.eof = False
-            self.mpv.command('loadfile', song.videofile)
-            self._wait_ev(mpv.Events.file_loaded)
+            ctx.set_property("audio-files", [song.audiofile])
+            ctx.command('stop')
+            yield from self._wait_ev(events, mpv.Events.idle)
+            ctx.command('loadfile', song.videofile)
+            yield from self._wait_ev(events, mpv.Events.file_loaded)
         elif song.videofile is None:
-            self.mpv.set_property("vid", "no")
+            ctx.set_property("vid", "no")
             if self.opts.mpv_visualizer:
-                self.mpv.set_property("lavfi-complex", self.opts.mpv_visualizer % {
+                ctx.set_property("lavfi-complex", self.opts.mpv_visualizer % {
                     "volume": song.volume,
                     "vo": "vo",
                     "ao": "ao"
                 })
-                self.mpv.set_property("keepaspect", False)
+                ctx.set_property("keepaspect", False)
                 # dim visualization a bit
-                self.mpv.set_property("brightness", -30)
+                ctx.set_property("brightness", -30)
 
         if "duration" in song.song:
-            self.duration = float(song.song["duration"])
+            st["duration"] = float(song.song["duration"])
 
-        self.file_duration = self._getprop("length")
+        st["file_duration"] = yield from self._getprop(ctx, events, "length")
 
-        ch = self._getprop("audio-params/channel-count")
+        ch = yield from self._getprop(ctx, events, "audio-params/channel-count")
         assert ch == 1 or (ch % 2 == 0)
-        self.channels = ((ch + 1) // 2) - 1
-        self.volumes = [0] * self.channels
-        self._update_matrix(True)
+        st["channels"] = ((ch + 1) // 2) - 1
 
         if self.rendering:
-            self.mpv.set_property("audio", False)
+            ctx.set_property("audio", False)
 
+        st["aspect"] = None
         if song.videofile is not None and self.display is not None:
-            w = self._getprop("video-params/w")
-            h = self._getprop("video-params/h")
-            aspect = self._getprop("video-params/aspect")
+            w = yield from self._getprop(ctx, events, "video-params/w")
+            h = yield from self._getprop(ctx, events, "video-params/h")
+            aspect = yield from self._getprop(ctx, events, "video-params/aspect")
 
             if song.aspect:
                 if not song.no_crop:
                     if song.aspect > aspect:
                         nh = int(h * (aspect / song.aspect))
-                        self.mpv.set_property("vf", "crop=%d:%d" % (w, nh))
+                        ctx.set_property("vf", "crop=%d:%d" % (w, nh))
                     elif aspect > song.aspect:
                         nw = int(w * (song.aspect / aspect))
-                        self.mpv.set_property("vf", "crop=%d:%d" % (nw, h))
-                self.aspect = song.aspect
+                        ctx.set_property("vf", "crop=%d:%d" % (nw, h))
+                st["aspect"] = song.aspect
             else:
-                self.mpv.set_property("vf", "")
-                self.aspect = aspect
+                ctx.set_property("vf", "")
+                st["aspect"] = aspect
+        return st
+
+    def preload(self, song):
+        """
+        Start loading song into a standby mpv context, so that a later
+        load_song(song) only has to swap it in. Loading proceeds in steps
+        from poll(), without blocking.
+        """
+        if self.preload_song is song or self.preload_failed is song:
+            return
+        self.preload_failed = None
+        if self.standby is None:
+            self.standby = self._create_context()
+        ctx = self.standby[0]
+        self.preload_song = song
+        self.preload_state = None
+        self.preload_job = self._loader(ctx, lambda: self._drain(ctx), song)
+
+    def poll_preload(self):
+        """
+        Run one step of the preload, if any. Returns how long a caller
+        waiting for it to finish should sleep before the next step.
+        """
+        if self.preload_job is None:
+            if self.standby is not None:
+                self._drain(self.standby[0])
+            return None
+        try:
+            return next(self.preload_job)
+        except StopIteration as e:
+            self.preload_job = None
+            self.preload_state = e.value
+        except Exception as e:
+            print("Preloading %s failed: %r" % (self.preload_song.audiofile, e))
+            # Do not retry until a different song is preloaded
+            self.preload_failed = self.preload_song
+            self.preload_job = None
+            self.preload_song = None
+        return None
+
+    def load_song(self, song):
+        if self.preload_song is not song:
+            self.preload_song = self.preload_job = self.preload_state = None
+        while self.preload_job is not None:
+            delay = self.poll_preload()
+            if delay:
+                time.sleep(delay)
+        if self.preload_state is not None:
+            self.mpv.command('stop')
+            (self.mpv, self.gl), self.standby = self.standby, (self.mpv, self.gl)
+            self.poll_props = dict.fromkeys(self.poll_props)
+            for i in self.poll_props:
+                self.mpv.get_property_async(i)
+            st = self.preload_state
         else:
-            self.aspect = None
+            self.poll()
+            job = self._loader(self.mpv, self.poll, song)
+            try:
+                while True:
+                    delay = next(job)
+                    if delay:
+                        time.sleep(delay)
+            except StopIteration as e:
+                st = e.value
+        self.preload_song = self.preload_job = self.preload_state = None
+
+        self.song = song
+        self.fadevol = 1
+        self.fade_in = 1
+        self.fade_out = 1
+        self.speed = 1
+        self.pause = True
+        self.pitch = 1
+        self.song_time = None
+        self.eof = False
+        if "fade_in" in song.song:
+            self.fade_in = float(song.song["fade_in"])
+        if "fade_out" in song.song:
+            self.fade_out = float(song.song["fade_out"])
+        self.duration = st["duration"]
+        self.file_duration = st["file_duration"]
+        self.offset = st["offset"]
+        self.aspect = st["aspect"]
+        self.channels = st["channels"]
+        self.volumes = [0] * self.channels
+        self._update_matrix(True)
 
-    def _getprop(self, p):
-        for i in range(10):
+    def _getprop(self, ctx, events, p):
+        deadline = time.time() + self.PROPERTY_TIMEOUT
+        while True:
             try:
-                return self.mpv.get_property(p)
+                return ctx.get_property(p)
             except mpv.MPVError: # Wait until available
-                self.poll()
-                time.sleep(0.1)
-        else:
-            raise Exception("Timed out getting property %s" % p)
+                if time.time() > deadline:
+                    raise Exception("Timed out getting property %s" % p)
+                events()
+                yield self.PROPERTY_RETRY_DELAY
 
-    def _wait_ev(self, ev_id):
+    def _wait_ev(self, events, ev_id):
         while True:
-            for i in self.poll():
+            for i in events():
                 if i.id == ev_id:
                     return
+            yield self.EVENT_RETRY_DELAY
 
     def play(self):
         self.set_pause(False)
@@ -265,6 +378,7 @@ class Player(object):
         self.mpv.set_property("time-pos", t)
 
     def poll(self):
+        self.poll_preload()
         if self.audio_reconfig_pending:
             self._update_matrix()
         repoll = set()
@@ -337,7 +451,13 @@ class Player(object):
         self.shutdown()
 
     def shutdown(self):
-        if self.gl:
-            self.gl.close()
-        self.mpv.shutdown()
+        for context in (self.standby, (self.mpv, self.gl)):
+            if context is None or context[0] is None:
+                continue
+            ctx, gl = context
+            if gl:
+                gl.close()
+            ctx.shutdown()
+        self.standby = None
+        self.mpv = self.gl = None
 
@@ -19,7 +19,7 @@
 import os
 import time
 
-from blitzloop import graphics, layout, mpvplayer, song, util
+from blitzloop import blitzc, graphics, layout, mpvplayer, song, util
 
 
 def entry():
@@ -38,7 +38,7 @@ def entry():
     opts = util.get_opts()
 
     fullscreen = opts.fullscreen
-    s = song.Song(opts.songpath)
+    s = blitzc.load_if_fresh(opts.songpath) or song.Song(opts.songpath)
 
     if fullscreen:
         display = graphics.Display(1920, 1200, fullscreen, None)
@@ -37,16 +37,19 @@ else:
 
 
 vs_karaoke = """
-attribute vec4 coords;
+attribute vec2 position;
+attribute vec2 texcoord;
 
-attribute vec3 border_color;
-attribute vec3 fill_color;
-attribute vec3 outline_color;
-attribute vec3 border_color_on;
-attribute vec3 fill_color_on;
-attribute vec3 outline_color_on;
+// RGB, the fourth component is padding
+attribute vec4 border_color;
+attribute vec4 fill_color;
+attribute vec4 outline_color;
+attribute vec4 border_color_on;
+attribute vec4 fill_color_on;
+attribute vec4 outline_color_on;
 
 attribute vec3 times;
+attribute vec4 strokes;
 
 uniform float time;
 uniform mat4 transform;
@@ -60,6 +63,7 @@ varying vec3 v_fill_color_on;
 varying vec3 v_outline_color_on;
 varying float v_alpha;
 varying float v_time;
+varying vec3 v_strokes;
 
 float fade = 0.5;
 
@@ -68,16 +72,17 @@ float linstep(float min, float max, float v) {
 }
 
 void main() {
-    v_texcoord = coords.zw;
+    v_texcoord = texcoord;
 
     v_time = times.x;
+    v_strokes = strokes.xyz;
 
-    v_fill_color = fill_color;
-    v_border_color = border_color;
-    v_outline_color = outline_color;
-    v_fill_color_on = fill_color_on;
-    v_border_color_on = border_color_on;
-    v_outline_color_on = outline_color_on;
+    v_fill_color = fill_color.rgb;
+    v_border_color = border_color.rgb;
+    v_outline_color = outline_color.rgb;
+    v_fill_color_on = fill_color_on.rgb;
+    v_border_color_on = border_color_on.rgb;
+    v_outline_color_on = outline_color_on.rgb;
 
     float line_start = times.y;
     float line_end = times.z;
@@ -87,7 +92,7 @@ void main() {
 
     v_alpha = fade_in - fade_out;
 
-    vec4 pos = vec4(coords.x, coords.y, 0.0, 1.0);
+    vec4 pos = vec4(position, 0.0, 1.0);
 
     float x_shift = 0.03;
 
@@ -144,6 +149,59 @@ void main() {
 }
 """
 
+# Fill, border and outline from a distance field (texture_font.SDFGlyph):
+# 0.5 is the glyph edge, v_strokes holds the border and outline edges and
+# the antialiasing width.
+fs_karaoke_sdf = """
+#ifdef GL_ES
+precision highp float;
+#endif
+
+uniform float time;
+uniform sampler2D tex;
+
+varying vec2 v_texcoord;
+varying vec3 v_border_color;
+varying vec3 v_fill_color;
+varying vec3 v_outline_color;
+varying vec3 v_border_color_on;
+varying vec3 v_fill_color_on;
+varying vec3 v_outline_color_on;
+varying float v_alpha;
+varying float v_time;
+varying vec3 v_strokes;
+
+
+void main() {
+    float dist = texture2D(tex, v_texcoord.st).r;
+    float aa = v_strokes.z;
+    float fill = smoothstep(0.5 - aa, 0.5 + aa, dist);
+    float border = smoothstep(v_strokes.x - aa, v_strokes.x + aa, dist);
+    float outline = smoothstep(v_strokes.y - aa, v_strokes.y + aa, dist);
+    outline -= border;
+    border -= fill;
+
+    vec3 outline_color, border_color, fill_color;
+    if (v_time < time) {
+        outline_color = v_outline_color_on;
+        border_color = v_border_color_on;
+        fill_color = v_fill_color_on;
+    } else {
+        outline_color = v_outline_color;
+        border_color = v_border_color;
+        fill_color = v_fill_color;
+    }
+
+    float a = (outline + border + fill);
+
+    gl_FragColor.rgb = outline_color * outline;
+    gl_FragColor.rgb += border_color * border;
+    gl_FragColor.rgb += fill_color * fill;
+    gl_FragColor.rgb *= v_alpha;
+    gl_FragColor.a = a * v_alpha;
+}
+"""
+
 vs_solid = """
 attribute vec3 coord;
 
@@ -211,42 +269,141 @@ void main() {
 }
 """
 
+# Colors in the order of the GlyphStore palettes (colors + colors_on)
+COLORS = ["fill_color", "border_color", "outline_color",
+          "fill_color_on", "border_color_on", "outline_color_on"]
+
+# Karaoke vertex layout (52 bytes). Texture coordinates and colors are
+# normalized integers, every attribute starts at a multiple of 4 bytes.
+VERTEX = np.dtype([
+    ("position", np.float32, 2),
+    ("texcoord", np.uint16, 2),
+    ("times", np.float32, 3),
+    ("strokes", np.uint8, 4),
+] + [(name, np.uint8, 4) for name in COLORS])
+
+def glyph_vertices(lines, offsets):
+    """
+    Returns the vertex data for the glyphs of lines (4 VERTEX records per
+    glyph), with each line positioned at its (x, y) offset.
+    """
+    stores = [line.glyphs for line in lines]
+    n = sum(len(store) for store in stores)
+    if not n:
+        return np.zeros(0, VERTEX)
+    gx, gy, tx1, tx2, t1, t2 = (
+        np.concatenate([store.column(name) for store in stores])
+        for name in ("x", "y", "tx1", "tx2", "t1", "t2"))
+
+    # Font glyph metrics and colors are shared by many glyphs, each line has
+    # tables of them that its glyphs index into
+    metrics = [g for store in stores for g in store.glyph_table]
+    palettes = [p for store in stores for p in store.palette_table]
+    metric_base = np.cumsum([0] + [len(store.glyph_table) for store in stores[:-1]])
+    palette_base = np.cumsum([0] + [len(store.palette_table) for store in stores[:-1]])
+    counts = [len(store) for store in stores]
+    metric_idx = (np.concatenate([store.column("glyph_id") for store in stores]) +
+                  np.repeat(metric_base, counts))
+    palette_idx = (np.concatenate([store.column("palette_id") for store in stores]) +
+                   np.repeat(palette_base, counts))
+    left, right, top, bot, tex_left, tex_right, tex_top, tex_bot, \
+        border_edge, outline_edge, aa = np.array(
+            [(g.left, g.right, g.top, g.bot,
+              g.tex_left, g.tex_right, g.tex_top, g.tex_bot) +
+             (g.strokes or (0, 0, 0)) for g in metrics],
+            np.float64)[metric_idx].T
+    colors = np.array([sum(colors + colors_on, ())
+                       for colors, colors_on in palettes], np.uint8)[palette_idx]
+
+    # Per-line values, repeated for each glyph of the line
+    x, y = np.repeat(np.array(offsets, np.float64).reshape(-1, 2), counts, 0).T
+    start, end = np.repeat(np.array([(line.start, line.end) for line in lines],
+                                    np.float64), counts, 0).T
+
+    x_left = x + gx + left
+    x_right = x + gx + right
+    y_bot = y + gy + bot
+    y_top = y + gy + top
+    if get_opts().instant:
+        tleft = tright = t1
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tleft = map_to(map_from(gx + left, tx1, tx2), t1, t2)
+            tright = map_to(map_from(gx + right, tx1, tx2), t1, t2)
+
+    # Corners: bottom left, top left, top right, bottom right
+    vbodata = np.zeros((n, 4), VERTEX)
+    vbodata["position"][:, :, 0] = np.stack([x_left, x_left, x_right, x_right], 1)
+    vbodata["position"][:, :, 1] = np.stack([y_bot, y_top, y_top, y_bot], 1)
+    tex_left, tex_right, tex_top, tex_bot = (
+        np.round(np.clip(c, 0, 1) * 65535) for c in (tex_left, tex_right, tex_top, tex_bot))
+    vbodata["texcoord"][:, :, 0] = np.stack([tex_left, tex_left, tex_right, tex_right], 1)
+    vbodata["texcoord"][:, :, 1] = np.stack([tex_bot, tex_top, tex_top, tex_bot], 1)
+    vbodata["times"][:, :, 0] = np.stack([tleft, tleft, tright, tright], 1)
+    vbodata["times"][:, :, 1] = start[:, None]
+    vbodata["times"][:, :, 2] = end[:, None]
+    for i, value in enumerate((border_edge, outline_edge, aa)):
+        vbodata["strokes"][:, :, i] = np.round(value * 255)[:, None]
+    for i, name in enumerate(COLORS):
+        vbodata[name][:, :, :3] = colors[:, None, 3*i:3*i+3]
+    return vbodata.reshape(n * 4)
+
+def page_ranges(lines):
+    """
+    Group the glyphs of lines by atlas page, keeping their order within each
+    page. Returns the glyph order to build the index buffer from, and for each
+    line a list of (page, start, count) glyph ranges into that order.
+    """
+    pages = [np.zeros(0, np.intp)]
+    for line in lines:
+        table = np.array([g.page for g in line.glyphs.glyph_table], np.intp)
+        pages.append(table[line.glyphs.column("glyph_id")])
+    pages = np.concatenate(pages)
+    if not len(pages) or not pages.any():
+        order = np.arange(len(pages))
+        ranges = []
+        base = 0
+        for line in lines:
+            count = len(line.glyphs)
+            ranges.append([(0, base, count)] if count else [])
+            base += count
+        return order, ranges
+
+    order = np.argsort(pages, kind="stable")
+    pos = np.empty_like(order)
+    pos[order] = np.arange(len(order))
+    ranges = []
+    base = 0
+    for line in lines:
+        count = len(line.glyphs)
+        line_pages = pages[base:base + count]
+        line_pos = pos[base:base + count]
+        ranges.append([(int(page), int(sel[0]), len(sel))
+                       for page in np.unique(line_pages)
+                       for sel in (line_pos[line_pages == page],)])
+        base += count
+    return order, ranges
+
 class RenderedLine(object):
     def __init__(self, line):
         self.line = line
         self.display = line.display
 
+    def vertices(self, x=0, y=0):
+        return glyph_vertices([self.line], [(x, y)])
+
+    QUAD = np.array([0, 1, 2, 2, 3, 0])
+
+    @classmethod
+    def indices(cls, order):
+        quads = np.asarray(order) * 4
+        return (quads[:, None] + cls.QUAD).ravel()
+
     def build(self):
-        vbodata = []
-        idxdata = []
-        for i,g in enumerate(self.line.glyphs):
-            if get_opts().instant:
-                tleft = tright = g.t1
-            else:
-                tleft = map_to(map_from(g.x + g.glyph.left, g.tx1, g.tx2), g.t1, g.t2)
-                tright = map_to(map_from(g.x + g.glyph.right, g.tx1, g.tx2), g.t1, g.t2)
-            const_vbodata = [self.line.start, self.line.end]
-            const_vbodata += list(i/255.0 for i in sum(g.colors + g.colors_on, ()))
-            vbodata.append(
-                [g.x + g.glyph.left, g.y + g.glyph.bot,
-                g.glyph.tex_left, g.glyph.tex_bot,
-                tleft] + const_vbodata)
-            vbodata.append(
-                [g.x + g.glyph.left, g.y + g.glyph.top,
-                g.glyph.tex_left, g.glyph.tex_top,
-                tleft] + const_vbodata)
-            vbodata.append(
-                [g.x + g.glyph.right, g.y + g.glyph.top,
-                g.glyph.tex_right, g.glyph.tex_top,
-                tright] + const_vbodata)
-            vbodata.append(
-                [g.x + g.glyph.right, g.y + g.glyph.bot,
-                g.glyph.tex_right, g.glyph.tex_bot,
-                tright] + const_vbodata)
-            idxdata += (i*4, i*4+1, i*4+2, i*4+2, i*4+3, i*4)
-        self.vbo = vbo.VBO(np.asarray(vbodata, np.float32), gl.GL_STATIC_DRAW, gl.GL_ARRAY_BUFFER)
-        self.ibo = vbo.VBO(np.asarray(idxdata, np.uint16), gl.GL_STATIC_DRAW, gl.GL_ELEMENT_ARRAY_BUFFER)
-        self.count = len(self.line.glyphs)
+        vbodata = self.vertices()
+        order, (self.ranges,) = page_ranges([self.line])
+        self.vbo = vbo.VBO(vbodata.view(np.uint8), gl.GL_STATIC_DRAW, gl.GL_ARRAY_BUFFER)
+        self.ibo = vbo.VBO(self.indices(order).astype(np.uint16), gl.GL_STATIC_DRAW, gl.GL_ELEMENT_ARRAY_BUFFER)
 
     def draw(self, renderer):
         with self.vbo, self.ibo:
@@ -256,27 +413,95 @@ class RenderedLine(object):
             self.display.matrix.translate(x, y)
             self.display.commit_matrix(renderer.l_transform)
 
-            stride = 25*4
-            off = 0
-            off += renderer.attrib_pointer("coords", stride, off, self.vbo)
-            off += renderer.attrib_pointer("times", stride, off, self.vbo)
-            off += renderer.attrib_pointer("fill_color", stride, off, self.vbo)
-            off += renderer.attrib_pointer("border_color", stride, off, self.vbo)
-            off += renderer.attrib_pointer("outline_color", stride, off, self.vbo)
-            off += renderer.attrib_pointer("fill_color_on", stride, off, self.vbo)
-            off += renderer.attrib_pointer("border_color_on", stride, off, self.vbo)
-            off += renderer.attrib_pointer("outline_color_on", stride, off, self.vbo)
-            assert off == stride
-
-            gl.glDrawElements(gl.GL_TRIANGLES, 6*self.count, gl.GL_UNSIGNED_SHORT, self.ibo)
+            renderer.attrib_pointers(self.vbo)
+            for page, start, count in self.ranges:
+                renderer.bind_page(page)
+                gl.glDrawElements(gl.GL_TRIANGLES, 6*count, gl.GL_UNSIGNED_SHORT, self.ibo + start * 12)
 
             self.display.matrix.pop()
 
+class RenderedLayout(object):
+    """
+    All the lines of a SongLayout packed into as few vertex buffers as the
+    16-bit indices allow, with the line positions baked into the vertices.
+    Within a buffer the indices are grouped by atlas page. Drawing a set of
+    lines takes one draw call per page and run of lines that are adjacent in
+    the buffer, instead of a buffer switch per line.
+    """
+    MAX_GLYPHS = 65536 // 4
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.display = lines[0].display if lines else None
+
+    def build(self):
+        self.chunks = []
+        self.ranges = {}
+        chunk = []
+        glyphs = 0
+        for line in self.lines:
+            count = len(line.glyphs)
+            if glyphs + count > self.MAX_GLYPHS:
+                self._add_chunk(chunk)
+                chunk = []
+                glyphs = 0
+            chunk.append(line)
+            glyphs += count
+        if glyphs:
+            self._add_chunk(chunk)
+
+    def _add_chunk(self, lines):
+        offsets = [(self.display.round_coord(line.x),
+                    self.display.round_coord(line.y)) for line in lines]
+        order, ranges = page_ranges(lines)
+        chunk = len(self.chunks)
+        for line, line_ranges in zip(lines, ranges):
+            self.ranges[line] = [(page, chunk, start * 6, count * 6)
+                                 for page, start, count in line_ranges]
+        self.chunks.append((
+            vbo.VBO(glyph_vertices(lines, offsets).view(np.uint8), gl.GL_STATIC_DRAW, gl.GL_ARRAY_BUFFER),
+            vbo.VBO(RenderedLine.indices(order).astype(np.uint16), gl.GL_STATIC_DRAW, gl.GL_ELEMENT_ARRAY_BUFFER)))
+
+    def draw(self, renderer, lines):
+        # Group by page, then merge lines that follow each other in the index
+        # buffer
+        ranges = sorted(r for line in lines for r in self.ranges[line])
+        runs = []
+        for page, chunk, start, count in ranges:
+            if runs and runs[-1][:2] == [page, chunk] and runs[-1][3] == start:
+                runs[-1][3] += count
+            else:
+                runs.append([page, chunk, start, start + count])
+        if not runs:
+            return
+
+        self.display.commit_matrix(renderer.l_transform)
+        bound = None
+        bound_page = None
+        for page, chunk, start, end in runs:
+            vbo_, ibo = self.chunks[chunk]
+            if bound != chunk:
+                if bound is not None:
+                    self.chunks[bound][0].unbind()
+                    self.chunks[bound][1].unbind()
+                vbo_.bind()
+                ibo.bind()
+                renderer.attrib_pointers(vbo_)
+                bound = chunk
+            if bound_page != page:
+                renderer.bind_page(page)
+                bound_page = page
+            gl.glDrawElements(gl.GL_TRIANGLES, end - start, gl.GL_UNSIGNED_SHORT, ibo + start * 2)
+        self.chunks[bound][0].unbind()
+        self.chunks[bound][1].unbind()
+
 _current_renderer = None
 
 class BaseRenderer(object):
     TYPE_LEN = {
-        gl.GL_FLOAT: 4
+        gl.GL_FLOAT: 4,
+        gl.GL_UNSIGNED_SHORT: 2,
+        gl.GL_UNSIGNED_BYTE: 1,
     }
     def __init__(self, display):
         self.display = display
@@ -289,10 +514,12 @@ class BaseRenderer(object):
         self.attrib_loc = {i: gl.glGetAttribLocation(self.shader, i) for i in self.ATTRIBUTES}
 
     def attrib_pointer(self, attrib, stride, offset, vbo):
-        size, data_type = self.ATTRIBUTES[attrib]
+        size, data_type, normalized = self.ATTRIBUTES[attrib]
         loc = self.attrib_loc[attrib]
         if loc >= 0:
-            gl.glVertexAttribPointer(loc, size, data_type, gl.GL_FALSE, stride, vbo + offset)
+            gl.glVertexAttribPointer(loc, size, data_type,
+                                     gl.GL_TRUE if normalized else gl.GL_FALSE,
+                                     stride, vbo + offset)
         return self.TYPE_LEN[data_type] * size
 
     def enable_attribs(self):
@@ -323,23 +550,37 @@ class KaraokeRenderer(BaseRenderer):
         "tex", "time", "transform",
     ]
     ATTRIBUTES = {
-        "coords": (4, gl.GL_FLOAT),
-        "times": (3, gl.GL_FLOAT),
-        "border_color": (3, gl.GL_FLOAT),
-        "fill_color": (3, gl.GL_FLOAT),
-        "outline_color": (3, gl.GL_FLOAT),
-        "border_color_on": (3, gl.GL_FLOAT),
-        "fill_color_on": (3, gl.GL_FLOAT),
-        "outline_color_on": (3, gl.GL_FLOAT),
+        "position": (2, gl.GL_FLOAT, False),
+        "texcoord": (2, gl.GL_UNSIGNED_SHORT, True),
+        "times": (3, gl.GL_FLOAT, False),
+        "strokes": (4, gl.GL_UNSIGNED_BYTE, True),
+        "border_color": (4, gl.GL_UNSIGNED_BYTE, True),
+        "fill_color": (4, gl.GL_UNSIGNED_BYTE, True),
+        "outline_color": (4, gl.GL_UNSIGNED_BYTE, True),
+        "border_color_on": (4, gl.GL_UNSIGNED_BYTE, True),
+        "fill_color_on": (4, gl.GL_UNSIGNED_BYTE, True),
+        "outline_color_on": (4, gl.GL_UNSIGNED_BYTE, True),
     }
     FS = fs_karaoke
     VS = vs_karaoke
     def __init__(self, display):
+        if get_opts().sdf_glyphs:
+            self.FS = fs_karaoke_sdf
         BaseRenderer.__init__(self, display)
-        self.atlas = texture_font.TextureAtlas(depth=3)
+        self.atlas = self.new_atlas()
+
+    def new_atlas(self):
+        return texture_font.PagedTextureAtlas(depth=3)
+
+    def attrib_pointers(self, vbo):
+        for name in VERTEX.names:
+            self.attrib_pointer(name, VERTEX.itemsize, VERTEX.fields[name][1], vbo)
+
+    def bind_page(self, page):
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.atlas.pages[page].texid)
 
     def setup(self):
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.atlas.texid)
+        self.bind_page(0)
         gl.glUseProgram(self.shader)
         gl.glUniform1i(self.l_tex, 0)
         self.enable_attribs()
@@ -353,15 +594,15 @@ class KaraokeRenderer(BaseRenderer):
         self.disable_attribs()
         gl.glUseProgram(0)
 
-    def reset(self):
-        self.atlas = texture_font.TextureAtlas(depth=3)
+    def reset(self, atlas=None):
+        self.atlas = atlas if atlas is not None else self.new_atlas()
 
 class SolidRenderer(BaseRenderer):
     UNIFORMS = [
         "color", "transform",
     ]
     ATTRIBUTES = {
-        "coord": (3, gl.GL_FLOAT),
+        "coord": (3, gl.GL_FLOAT, False),
     }
     VS = vs_solid
     FS = fs_solid
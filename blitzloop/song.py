@@ -17,12 +17,17 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 from collections import OrderedDict
+import bisect
 import codecs
+import copy
 import decimal
 import fractions
 import os.path
 import re
 import sys
+import threading
+
+import numpy as np
 
 from blitzloop import util
 
@@ -403,11 +408,14 @@ FORMATS = {
 I_FORMATS = dict((v, k) for k, v in FORMATS.items())
 
 class Compound(OrderedDict):
-    def __init__(self, song_timing):
+    def __init__(self, song_timing=None):
         OrderedDict.__init__(self)
         self.start = None
         self.timing = None
         self.song_timing = song_timing
+        # Song time of every step boundary, computed from timing on demand
+        self.step_times = None
+        self._step_key = None
 
     @property
     def steps(self):
@@ -417,16 +425,44 @@ class Compound(OrderedDict):
     def end(self):
         return self.start + sum(self.timing)
 
+    @property
+    def is_timed(self):
+        return self.timing is not None and self.song_timing is not None
+
+    def _timing_key(self):
+        # The editing tools append to timing in place, so track its length
+        return (self.start, id(self.timing), len(self.timing),
+                id(self.song_timing))
+
+    def step_offsets(self):
+        """
+        Beat of every step boundary, as floats. The running sum is done on
+        the exact timing values, and only the results are rounded.
+        """
+        offsets = [float(self.start)]
+        beat = self.start
+        for t in self.timing:
+            beat += t
+            offsets.append(float(beat))
+        return offsets
+
+    def set_step_times(self, step_times):
+        self.step_times = step_times
+        self._step_key = self._timing_key()
+
+    def get_step_times(self):
+        if self.step_times is None or self._step_key != self._timing_key():
+            times = self.song_timing.beat2time_many(self.step_offsets())
+            self.set_step_times(times.tolist())
+        return self.step_times
+
     def get_atom_time(self, steps, length):
-        if self.timing is not None and self.song_timing is not None:
+        if self.is_timed:
+            step_times = self.get_step_times()
             if self.timing:
-                start = self.start + sum(self.timing[i] for i in range(steps))
-                end = start + sum(self.timing[i] for i in range(steps, steps + length))
-                start = self.song_timing.beat2time(start)
-                end = self.song_timing.beat2time(end)
+                return step_times[steps], step_times[steps + length]
             else:
-                single = self.song_timing.beat2time(self.start)
-                return single, single
+                return step_times[0], step_times[0]
         else:
             start = self.start + steps
             end = start + length
@@ -434,40 +470,79 @@ class Compound(OrderedDict):
 
 class BeatCounter(object):
     def __init__(self):
-        self.beats = []
+        self._beats = []
+        self._changes = 0
+        self._segments = None
+
+    @property
+    def beats(self):
+        # Read only: changes must go through add() or set_beat(), which
+        # invalidate the lookup tables
+        return tuple(self._beats)
 
     def add(self, time, beat):
-        self.beats.append((time, beat))
+        self._beats.append((time, beat))
+        self._changes += 1
+
+    def set_beat(self, index, time, beat):
+        self._beats[index] = (time, beat)
+        self._changes += 1
+
+    @property
+    def segments(self):
+        # Sorted control point times/beats, plus NumPy copies for the
+        # vectorized lookups. Rebuilt after every change to the beats.
+        if self._segments is None or self._segments[0] != self._changes:
+            times = [float(t) for t, b in self._beats]
+            beats = [float(b) for t, b in self._beats]
+            self._segments = (self._changes, times, beats,
+                              np.array(times), np.array(beats))
+        return self._segments
+
+    def _segment(self, points, x):
+        # Index of the segment to interpolate x in, or None if x lies before
+        # the first control point. The last segment is used to extrapolate.
+        i = bisect.bisect_right(points, x)
+        if i == 0:
+            return None
+        return min(i, len(points) - 1) - 1
 
     def time2beat(self, t):
-        time1 = None
-        for time2, beat2 in self.beats:
-            if time2 > t:
-                if time1 is None:
-                    return 0
-                else:
-                    frac = (t - time1) / (time2 - time1)
-                    return beat1 + frac * (beat2 - beat1)
-            time1, beat1 = time2, beat2
-        time1, beat1 = self.beats[-2]
+        changes, times, beats, a_times, a_beats = self.segments
+        i = self._segment(times, t)
+        if i is None:
+            return 0
+        time1, beat1 = self._beats[i]
+        time2, beat2 = self._beats[i + 1]
         frac = (t - time1) / (time2 - time1)
         return beat1 + frac * (beat2 - beat1)
 
     def beat2time(self, beat):
         beat = float(beat)
-        beat1 = None
-        for time2, beat2 in self.beats:
-            if beat2 > beat:
-                if beat1 is None:
-                    return 0
-                else:
-                    frac = (beat - beat1) / (beat2 - beat1)
-                    return time1 + frac * (time2 - time1)
-            time1, beat1 = time2, beat2
-        time1, beat1 = self.beats[-2]
+        changes, times, beats, a_times, a_beats = self.segments
+        i = self._segment(beats, beat)
+        if i is None:
+            return 0
+        time1, beat1 = self._beats[i]
+        time2, beat2 = self._beats[i + 1]
         frac = (beat - beat1) / (beat2 - beat1)
         return time1 + frac * (time2 - time1)
 
+    def beat2time_many(self, beats):
+        """
+        Vectorized beat2time: converts an array of beats to an array of
+        times in one go.
+        """
+        beats = np.asarray(beats, dtype=np.float64)
+        changes, times, l_beats, a_times, a_beats = self.segments
+        n = len(times)
+        idx = np.searchsorted(a_beats, beats, side="right")
+        i = np.minimum(idx, n - 1) - 1
+        time1, beat1 = a_times[i], a_beats[i]
+        time2, beat2 = a_times[i + 1], a_beats[i + 1]
+        frac = (beats - beat1) / (beat2 - beat1)
+        return np.where(idx == 0, 0.0, time1 + frac * (time2 - time1))
+
 class MixedFraction(fractions.Fraction):
     def __new__(cls, a, b=None):
         if b is not None:
@@ -622,32 +697,74 @@ class Variant(object):
                 else:
                     raise ParseError("Tag %s in variant %s must have a style" % (tag, self.name))
 
+class BodyCache(object):
+    """
+    Bounded LRU holding the parsed bodies (styles, variants and lyrics) of
+    lazily loaded songs. Songs not in the cache are re-read from disk.
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self.lock = threading.Lock()
+        self.bodies = OrderedDict()
+        self.pending = {}
+
+    def get(self, song):
+        # Parse outside the lock so one slow song does not stall every other
+        # lookup; concurrent lookups of the same song wait for that parse.
+        while True:
+            with self.lock:
+                body = self.bodies.get(song)
+                if body is not None:
+                    self.bodies.move_to_end(song)
+                    return body
+                parsing = self.pending.get(song)
+                if parsing is None:
+                    parsing = self.pending[song] = threading.Event()
+                    break
+            parsing.wait()
+        try:
+            body = song.parse_body()
+            with self.lock:
+                self.bodies[song] = body
+                while len(self.bodies) > max(1, self.size):
+                    self.bodies.popitem(last=False)
+            return body
+        finally:
+            with self.lock:
+                del self.pending[song]
+            parsing.set()
+
+body_cache = BodyCache()
+
+def _body_property(name):
+    def getter(self):
+        if self._body is not None:
+            return self._body[name]
+        return body_cache.get(self)[name]
+    def setter(self, value):
+        if self._body is None:
+            # Pin the body to the song, so the LRU cannot evict the edit
+            self._body = body_cache.get(self)
+        self._body[name] = value
+    return property(getter, setter)
+
 class Song(object):
-    def __init__(self, filename=None, ignore_steps=False):
-        parsers = {
-            "Meta": self.parse_meta,
-            "Song": self.parse_song,
-            "Timing": self.parse_timing,
-            "Formats": self.parse_formats,
-            "Styles": self.parse_styles,
-            "Variants": self.parse_variants,
-            "Lyrics": self.parse_lyrics,
-        }
+    HEADER_SECTIONS = ("Meta", "Song", "Timing", "Formats")
+    BODY_SECTIONS = ("Styles", "Variants", "Lyrics")
+
+    styles = _body_property("styles")
+    variants = _body_property("variants")
+    compounds = _body_property("compounds")
+
+    def __init__(self, filename=None, ignore_steps=False, lazy=False):
         self.ignore_steps = ignore_steps
+        self.filename = filename
         self.pathbase = os.path.dirname(filename) if filename else None
-        section = None
-        lines = []
         self.meta = None
         self.song = None
         self.timing = None
         self.formats = None
-        self.styles = None
-        self.variants = None
-        self.compounds = None
-
-        self.fake_time = 0
-        self.line = 0
-        self.section_line = 0
+        self._body = {"styles": None, "variants": None, "compounds": None}
 
         if not filename:
             self.meta = OrderedDict()
@@ -659,31 +776,74 @@ class Song(object):
             self.compounds = []
             return
 
-        for line in codecs.open(filename, encoding='utf-8', mode='r'):
-            self.line += 1
-            line = line.replace("\n","").replace("\r","")
-            if line.startswith("#"):
-                continue
-            if section is None:
-                if not line:
+        if lazy:
+            # Only read the header now, the rest on demand into body_cache
+            self.parse_file(self.HEADER_SECTIONS)
+            self._body = None
+        else:
+            self.parse_file(self.HEADER_SECTIONS + self.BODY_SECTIONS)
+            self.load_variants()
+
+    def parse_file(self, sections):
+        parsers = {
+            "Meta": self.parse_meta,
+            "Song": self.parse_song,
+            "Timing": self.parse_timing,
+            "Formats": self.parse_formats,
+            "Styles": self.parse_styles,
+            "Variants": self.parse_variants,
+            "Lyrics": self.parse_lyrics,
+        }
+        wanted = set(sections)
+        section = None
+        lines = []
+        self.fake_time = 0
+        self.line = 0
+        self.section_line = 0
+
+        with codecs.open(self.filename, encoding='utf-8', mode='r') as fd:
+            for line in fd:
+                self.line += 1
+                line = line.replace("\n","").replace("\r","")
+                if line.startswith("#"):
                     continue
-                if line[0] != "[" or line[-1] != "]":
-                    raise ParseError("Expected section header")
-                section = line[1:-1]
-                self.section_line = self.line
-                continue
-            if line and line[0] == "[" and line[-1] == "]":
-                if section not in parsers:
-                    raise ParseError("Unknown section %s" % section)
-                parsers[section](lines)
-                lines = []
-                section = line[1:-1]
-                self.section_line = self.line
-            else:
-                lines.append(line)
+                if section is None:
+                    if not line:
+                        continue
+                    if line[0] != "[" or line[-1] != "]":
+                        raise ParseError("Expected section header")
+                    section = line[1:-1]
+                    self.section_line = self.line
+                    continue
+                if line and line[0] == "[" and line[-1] == "]":
+                    if section not in parsers:
+                        raise ParseError("Unknown section %s" % section)
+                    if section in wanted:
+                        parsers[section](lines)
+                        wanted.discard(section)
+                        if not wanted:
+                            return
+                    lines = []
+                    section = line[1:-1]
+                    self.section_line = self.line
+                elif section in wanted:
+                    lines.append(line)
         if section is not None:
-            parsers[section](lines)
+            if section not in parsers:
+                raise ParseError("Unknown section %s" % section)
+            if section in wanted:
+                parsers[section](lines)
+
+    def parse_body(self):
+        # Parse into a shallow copy, so other threads never see a half-built
+        # body through this song.
+        parser = copy.copy(self)
+        parser._body = {"styles": None, "variants": None, "compounds": None}
+        parser.parse_file(self.BODY_SECTIONS)
+        parser.load_variants()
+        return parser._body
 
+    def load_variants(self):
         if self.variants and self.styles:
             for variant in self.variants.values():
                 variant.load_tags(self.styles)
@@ -928,6 +1088,27 @@ class Song(object):
             else:
                 return ["Ch %d" % (i+1) for i in range(self.channels)]
 
+    def precompute_timing(self):
+        """
+        Compute the step times of every timed compound in one vectorized
+        beat2time pass, instead of compound by compound.
+        """
+        pending = []
+        offsets = []
+        for compound in self.compounds:
+            if not compound.is_timed:
+                continue
+            if (compound.step_times is not None and
+                compound._step_key == compound._timing_key()):
+                continue
+            pending.append((compound, len(offsets)))
+            offsets += compound.step_offsets()
+        if not pending:
+            return
+        times = self.timing.beat2time_many(offsets).tolist()
+        for compound, off in pending:
+            compound.set_step_times(times[off:off + len(compound.timing) + 1])
+
     def get_lyric_snippet(self, variant_id, length=100):
         variant = self.variants[variant_id]
         tags = set(i for i in variant.tag_list if variant.tags[i].edge == TagInfo.BOTTOM)
@@ -16,27 +16,200 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import functools
+import multiprocessing
 import os
+import pickle
 import threading
+import time
 
+from blitzloop import blitzc
 from blitzloop.song import Song
 
 
+def _parse_song(path, lazy=False):
+    song = blitzc.load_if_fresh(path, lazy)
+    if song is None:
+        print(path)
+        song = Song(path, lazy=lazy)
+    return song
+
 class SongDatabase(object):
-    def __init__(self, root):
+    """
+    The songs under root, indexed by id. A song keeps its id while
+    blitzloop runs, even if it is removed and comes back. Ids are stored in
+    cache_file and reused on the next start, so they only stay stable
+    across restarts when there is a song cache.
+    """
+    # Bump this whenever the pickled representation of Song changes
+    CACHE_VERSION = 6
+
+    def __init__(self, root, cache_file=None, workers=1, lazy=False):
+        self.root = root
         self.songs = []
+        # path -> ((mtime, size), id); removed songs keep their id, with a key
+        # of None, so that they get it back if they reappear.
+        self.paths = {}
+        self.lock = threading.RLock()
+        self.cache_file = cache_file
+        self.workers = workers or os.cpu_count() or 1
+        self.lazy = lazy
         self.load(root)
 
     def load(self, root):
+        cache, ids = self._load_cache()
+        t_start = time.time()
+        paths = self._walk(root)
+        t_walk = time.time()
+
+        todo = []
+        for path, key in paths:
+            entry = cache.get(path)
+            if entry is None or entry[0] != key:
+                todo.append(path)
+        parse = functools.partial(_parse_song, lazy=self.lazy)
+        if self.workers > 1 and len(todo) > 1:
+            with multiprocessing.Pool(self.workers) as pool:
+                chunksize = max(1, min(64, len(todo) // (self.workers * 4)))
+                parsed = pool.map(parse, todo, chunksize)
+        else:
+            parsed = list(map(parse, todo))
+        parsed = dict(zip(todo, parsed))
+        t_parse = time.time()
+
+        # Give songs the ids they had last time, and new songs ids in walk
+        # order, independently of which process parsed what
+        with self.lock:
+            if ids:
+                self.songs = [None] * (max(ids.values()) + 1)
+                for path, id in ids.items():
+                    self.paths[path] = None, id
+            for path, key in paths:
+                if path in parsed:
+                    song = parsed[path]
+                else:
+                    song = cache[path][1]
+                self._set(path, key, song)
+        if parsed or len(paths) != len(cache):
+            self._save_cache()
+        t_merge = time.time()
+
+        print("Song DB: %d songs (%d parsed, %d workers): "
+              "walk %.2fs, parse %.2fs, merge %.2fs" % (
+              len(paths), len(todo), self.workers,
+              t_walk - t_start, t_parse - t_walk, t_merge - t_parse))
+
+    def refresh(self, paths=None):
+        """
+        Re-scan the given files or directories (by default the whole song
+        root) and add, update or remove the songs found there. Returns True if
+        anything changed.
+        """
+        if paths is None:
+            paths = [self.root]
+        found = {}
+        gone = set()
+        for path in paths:
+            if os.path.isdir(path):
+                found.update(self._walk(path))
+            elif path.endswith(".blitz"):
+                key = self._stat(path)
+                if key is not None:
+                    found[path] = key
+            prefix = os.path.join(path, "")
+            with self.lock:
+                gone.update(p for p in self.paths
+                            if p == path or p.startswith(prefix))
+
+        with self.lock:
+            changed = [p for p, key in found.items()
+                       if p not in self.paths or self.paths[p][0] != key]
+            removed = [p for p in gone
+                       if p not in found and self.paths[p][0] is not None]
+
+        parsed = {}
+        for path in changed:
+            try:
+                parsed[path] = _parse_song(path, self.lazy)
+            except Exception as e:
+                print("Failed to load %s: %r" % (path, e))
+        if not parsed and not removed:
+            return False
+
+        with self.lock:
+            for path, song in parsed.items():
+                self._set(path, found[path], song)
+            for path in removed:
+                key, id = self.paths[path]
+                self.paths[path] = None, id
+                self.songs[id] = None
+        self._save_cache()
+        print("Song DB: %d songs updated, %d removed" % (len(parsed), len(removed)))
+        return True
+
+    def _set(self, path, key, song):
+        if path in self.paths:
+            song.id = self.paths[path][1]
+            self.songs[song.id] = song
+        else:
+            song.id = len(self.songs)
+            self.songs.append(song)
+        self.paths[path] = key, song.id
+
+    def _walk(self, root):
+        paths = []
         for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
             for name in filenames:
                 if not name.endswith(".blitz"):
                     continue
                 path = os.path.join(dirpath, name)
-                print(path)
-                song = Song(path)
-                song.id = len(self.songs)
-                self.songs.append(song)
+                key = self._stat(path)
+                if key is not None:
+                    paths.append((path, key))
+        return paths
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _load_cache(self):
+        # Returns the cached songs by path, and the ids of all songs seen
+        # before (including removed ones) by path
+        if not self.cache_file:
+            return {}, {}
+        try:
+            with open(self.cache_file, "rb") as fd:
+                version, entries, ids = pickle.load(fd)
+        except FileNotFoundError:
+            return {}, {}
+        except Exception as e:
+            print("Song cache %s unusable, ignoring: %r" % (self.cache_file, e))
+            return {}, {}
+        if version != (self.CACHE_VERSION, self.lazy):
+            return {}, {}
+        print("Loaded %d songs from cache" % len(entries))
+        return entries, ids
+
+    def _save_cache(self):
+        if not self.cache_file:
+            return
+        with self.lock:
+            entries = dict((path, (key, self.songs[id]))
+                           for path, (key, id) in self.paths.items()
+                           if key is not None)
+            ids = dict((path, id) for path, (key, id) in self.paths.items())
+        tmp = self.cache_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(tmp, "wb") as fd:
+                pickle.dump(((self.CACHE_VERSION, self.lazy), entries, ids),
+                            fd, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            print("Failed to write song cache %s: %r" % (self.cache_file, e))
 
 class SongQueueEntry(object):
     def __init__(self, song):
@@ -92,7 +265,7 @@ class SongQueue(object):
         return len(self.queue)
 
     def __getitem__(self, idx):
-        return self.queue[0]
+        return self.queue[idx]
 
     def __iter__(self):
         return iter(self.queue)
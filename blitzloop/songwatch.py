@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+class Inotify(object):
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify not supported")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise("inotify_init1")
+        self.watches = {}
+
+    def _raise(self, what):
+        err = ctypes.get_errno()
+        raise OSError(err, "%s: %s" % (what, os.strerror(err)))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise("inotify_add_watch(%s)" % path)
+        self.watches[wd] = path
+
+    def remove_tree(self, path):
+        """
+        Drop the watches on path and everything below it. Watches follow
+        directories when they move, so they would keep reporting the old
+        path.
+        """
+        prefix = os.path.join(path, "")
+        for wd, wpath in list(self.watches.items()):
+            if wpath == path or wpath.startswith(prefix):
+                del self.watches[wd]
+                # Fails if the kernel already dropped it, which is fine
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        off = 0
+        while off < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, off)
+            off += self.EVENT.size
+            name = os.fsdecode(data[off:off + length].rstrip(b"\0"))
+            off += length
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class SongWatcher(threading.Thread):
+    """
+    Keeps a SongDatabase up to date with its song directory while blitzloop
+    is running. Uses inotify where available, and falls back to rescanning
+    the whole tree every poll_interval seconds otherwise.
+    """
+
+    # Wait for changes to settle before re-parsing (editors save in bursts)
+    SETTLE_TIME = 1.0
+
+    def __init__(self, database, poll_interval=60):
+        self.database = database
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+        threading.Thread.__init__(self)
+
+    def run(self):
+        try:
+            self._run_inotify()
+        except OSError as e:
+            if self.stopping.is_set():
+                return
+            print("songwatch: inotify unavailable (%s), polling every %ds" % (
+                e, self.poll_interval))
+            self._run_poll()
+        print("songwatch: thread exited")
+
+    def _run_poll(self):
+        while not self.stopping.wait(self.poll_interval):
+            self.database.refresh()
+
+    def _watch_tree(self, inotify, root):
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+            inotify.add_watch(dirpath)
+
+    def _run_inotify(self):
+        inotify = Inotify()
+        try:
+            self._watch_tree(inotify, self.database.root)
+            print("songwatch: watching %d directories" % len(inotify.watches))
+            # Catch anything that changed while we were setting up watches
+            self.database.refresh()
+            pending = set()
+            deadline = None
+            while not self.stopping.is_set():
+                timeout = 0.5
+                if deadline is not None:
+                    timeout = max(0, min(timeout, deadline - time.time()))
+                for path, mask, name in inotify.read(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        pending.add(self.database.root)
+                    elif path is None or mask & IN_IGNORED:
+                        continue
+                    elif mask & IN_MOVE_SELF:
+                        # A watched directory moved away (its parent, if
+                        # watched, reports the new location)
+                        inotify.remove_tree(path)
+                        pending.add(path)
+                    elif mask & IN_ISDIR:
+                        full = os.path.join(path, name)
+                        if mask & IN_MOVED_FROM:
+                            inotify.remove_tree(full)
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            self._watch_tree(inotify, full)
+                        pending.add(full)
+                    elif name.endswith(".blitz"):
+                        pending.add(os.path.join(path, name))
+                    else:
+                        continue
+                    if deadline is None:
+                        deadline = time.time() + self.SETTLE_TIME
+                if deadline is not None and time.time() >= deadline:
+                    self.database.refresh(sorted(pending))
+                    pending.clear()
+                    deadline = None
+        finally:
+            inotify.close()
+
+    def stop(self):
+        self.stopping.set()
@@ -16,10 +16,18 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+from collections import OrderedDict
+import bisect
+import copy
+import ctypes
 import freetype as ft
+import hashlib
 import math
 import numpy as np
+import os
+import pickle
 import sys
+import threading
 
 from blitzloop import graphics
 
@@ -36,6 +44,11 @@ class TextureAtlas(object):
     the Skyline Bottom-Left algorithm based on C++ sources provided by Jukka
     Jylänki at: http://clb.demon.fi/files/RectangleBinPack/
 
+    The skyline is kept as parallel lists of node x, y and width, so that
+    the nodes under a candidate position can be found by bisection and their
+    height taken with a single max() over a slice. Use get_regions to pack
+    many regions at once, tallest first, which packs tighter.
+
     Example usage:
     --------------
 
@@ -64,20 +77,25 @@ class TextureAtlas(object):
         self.width = int(math.pow(2, int(math.log(width, 2) + 0.5)))
         self.height = int(math.pow(2, int(math.log(height, 2) + 0.5)))
         self.depth = depth
-        self.nodes = [ (0,0,self.width), ]
+        self.xs = [0]
+        self.ys = [0]
+        self.ws = [self.width]
         self.data = np.zeros((self.height, self.width, self.depth), dtype=np.ubyte)
         self.texid = None
         self.used = 0
-        self._dirty = True
+        self.dirty = []
+        self._allocated = False
 
     def upload(self):
         '''
-        Upload atlas data into video memory.
+        Upload atlas data into video memory. The texture storage is allocated
+        and filled once; after that only the regions written since the last
+        upload are sent.
         '''
 
         gl = graphics.GL()
 
-        if not self._dirty:
+        if self._allocated and not self.dirty:
             return
 
         if self.texid is None:
@@ -91,17 +109,42 @@ class TextureAtlas(object):
         }
         ifmt, fmt = FORMATS[self.depth]
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.texid)
-        gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE )
-        gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE )
-        gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR )
-        gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR )
-        #gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST )
-        #gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST )
-        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, fmt,
-                        self.width, self.height, 0,
-                        fmt, gl.GL_UNSIGNED_BYTE, self.data)
-
-        self._dirty = False
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+
+        if not self._allocated:
+            gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE )
+            gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE )
+            gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR )
+            gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR )
+            #gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST )
+            #gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST )
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, fmt,
+                            self.width, self.height, 0,
+                            fmt, gl.GL_UNSIGNED_BYTE, self.data)
+            self._allocated = True
+        else:
+            for x, y, width, height in self.dirty_rects():
+                gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, x, y, width, height,
+                                   fmt, gl.GL_UNSIGNED_BYTE,
+                                   np.ascontiguousarray(self.data[y:y+height,x:x+width]))
+
+        self.dirty = []
+
+    def dirty_rects(self):
+        '''
+        Rectangles to upload for the regions written since the last upload.
+        Falls back to their bounding box when that does not upload much more
+        than the regions themselves, to save on calls.
+        '''
+
+        x1 = min(x for x, y, w, h in self.dirty)
+        y1 = min(y for x, y, w, h in self.dirty)
+        x2 = max(x + w for x, y, w, h in self.dirty)
+        y2 = max(y + h for x, y, w, h in self.dirty)
+        area = sum(w * h for x, y, w, h in self.dirty)
+        if (x2 - x1) * (y2 - y1) <= 2 * area:
+            return [(x1, y1, x2 - x1, y2 - y1)]
+        return self.dirty
 
     def set_region(self, region, data):
         '''
@@ -119,7 +162,7 @@ class TextureAtlas(object):
 
         x, y, width, height = region
         self.data[y:y+height,x:x+width, :] = data
-        self._dirty = True
+        self.dirty.append((x, y, width, height))
 
     def get_region(self, width, height):
         '''
@@ -139,98 +182,67 @@ class TextureAtlas(object):
             A newly allocated region as (x,y,width,height) or None
         '''
 
+        xs, ys, ws = self.xs, self.ys, self.ws
         best_height = sys.maxsize
-        best_index = None
         best_width = sys.maxsize
-        region = 0, 0, width, height
-
-        for i in range(len(self.nodes)):
-            y = self.fit(i, width, height)
-            if y is not None:
-                node = self.nodes[i]
-                if (y+height < best_height or
-                    (y+height == best_height and node[2] < best_width)):
-                    best_height = y+height
-                    best_index = i
-                    best_width = node[2]
-                    region = node[0], y, width, height
+        best_index = None
+        best_y = None
+
+        for i in range(bisect.bisect_right(xs, self.width - width)):
+            # The region can only rest on this node or higher
+            if ys[i] + height > best_height or (
+                ys[i] + height == best_height and ws[i] >= best_width):
+                continue
+            j = bisect.bisect_left(xs, xs[i] + width, i + 1)
+            y = max(ys[i:j])
+            if y + height > self.height:
+                continue
+            if (y + height < best_height or
+                (y + height == best_height and ws[i] < best_width)):
+                best_height = y + height
+                best_width = ws[i]
+                best_index = i
+                best_y = y
 
         if best_index is None:
             return None
 
-        node = region[0], region[1]+height, width
-        self.nodes.insert(best_index, node)
-
-        i = best_index+1
-        while i < len(self.nodes):
-            node = self.nodes[i]
-            prev_node = self.nodes[i-1]
-            if node[0] < prev_node[0]+prev_node[2]:
-                shrink = prev_node[0]+prev_node[2] - node[0]
-                x,y,w = self.nodes[i]
-                self.nodes[i] = x+shrink, y, w-shrink
-                if self.nodes[i][2] <= 0:
-                    del self.nodes[i]
-                    i -= 1
-                else:
-                    break
-            else:
-                break
-            i += 1
+        i = best_index
+        x = xs[i]
+        end = x + width
+        # Nodes under the new one are replaced, the last one may be cut
+        j = bisect.bisect_left(xs, end, i)
+        last_end = xs[j - 1] + ws[j - 1]
+        if last_end > end:
+            xs[j - 1] = end
+            ws[j - 1] = last_end - end
+            j -= 1
+        xs[i:j] = [x]
+        ys[i:j] = [best_height]
+        ws[i:j] = [width]
+
+        # Merge with neighbours at the same height
+        if i + 1 < len(xs) and ys[i + 1] == best_height:
+            ws[i] += ws[i + 1]
+            del xs[i + 1], ys[i + 1], ws[i + 1]
+        if i > 0 and ys[i - 1] == best_height:
+            ws[i - 1] += ws[i]
+            del xs[i], ys[i], ws[i]
 
-        self.merge()
         self.used += width*height
-        return region
-
-    def fit(self, index, width, height):
-        '''
-        Test if region (width,height) fit into self.nodes[index]
-
-        Parameters
-        ----------
-
-        index : int
-            Index of the internal node to be tested
-
-        width : int
-            Width or the region to be tested
-
-        height : int
-            Height or the region to be tested
-
-        '''
-
-        node = self.nodes[index]
-        x,y = node[0], node[1]
-        width_left = width
-
-        if x+width > self.width:
-            return None
+        return x, best_y, width, height
 
-        i = index
-        while width_left > 0:
-            node = self.nodes[i]
-            y = max(y, node[1])
-            if y+height > self.height:
-                return None
-            width_left -= node[2]
-            i += 1
-        return y
-
-    def merge(self):
+    def get_regions(self, sizes):
         '''
-        Merge nodes
+        Allocate regions for a list of (width, height) sizes, tallest first.
+        Returns the regions in the order of sizes, with None for those that
+        did not fit.
         '''
 
-        i = 0
-        while i < len(self.nodes)-1:
-            node = self.nodes[i]
-            next_node = self.nodes[i+1]
-            if node[1] == next_node[1]:
-                self.nodes[i] = node[0], node[1], node[2]+next_node[2]
-                del self.nodes[i+1]
-            else:
-                i += 1
+        regions = [None] * len(sizes)
+        for i in _tallest_first(sizes):
+            regions[i] = self.get_region(*sizes[i])
+        return regions
 
     def __del__(self):
         if self.texid is not None:
@@ -242,20 +254,77 @@ class TextureAtlas(object):
                 tex = arrays.GLintArray.asArray([self.texid])
                 gl.glDeleteTextures(1, tex)
 
+def _tallest_first(sizes):
+    return sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+
+class PagedTextureAtlas(object):
+    '''
+    A growing set of TextureAtlas pages. Regions are allocated from the
+    existing pages first, and a new page is added when none has room, so
+    the atlas never fills up. Regions are (page, x, y, width, height).
+    '''
+
+    def __init__(self, width=2048, height=2048, depth=1):
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.pages = []
+        self.shared = {}
+        # Pages round their size to a power of two, so use theirs
+        page = self.add_page()
+        self.width, self.height = page.width, page.height
+
+    def add_page(self):
+        page = TextureAtlas(self.width, self.height, self.depth)
+        self.pages.append(page)
+        return page
+
+    def get_region(self, width, height):
+        for i, page in enumerate(self.pages):
+            region = page.get_region(width, height)
+            if region is not None:
+                return (i,) + region
+        region = self.add_page().get_region(width, height)
+        if region is None:
+            return None
+        return (len(self.pages) - 1,) + region
+
+    def get_regions(self, sizes):
+        regions = [None] * len(sizes)
+        for i in _tallest_first(sizes):
+            regions[i] = self.get_region(*sizes[i])
+        return regions
+
+    def set_region(self, region, data):
+        self.pages[region[0]].set_region(region[1:], data)
+
+    def upload(self):
+        for page in self.pages:
+            page.upload()
+
+    @property
+    def used(self):
+        return sum(page.used for page in self.pages)
+
 def bitmap_to_numpy(bitmap, dtype=np.uint8):
-    pitch = bitmap.pitch
-    width = bitmap.width
-    buf = bitmap.buffer
-    arr = np.array(buf,dtype=dtype).reshape(bitmap.rows, bitmap.pitch)
-    if pitch != width:
-        return arr[:,:width]
-    else:
-        return arr
+    '''
+    View a FreeType bitmap as a (rows, width) array without copying it. The
+    array is only valid for as long as the bitmap is.
+    '''
+    rows, width, pitch = bitmap.rows, bitmap.width, bitmap.pitch
+    if not rows or not width:
+        return np.zeros((rows, width), dtype=dtype)
+    buf = (ctypes.c_ubyte * (rows * abs(pitch))).from_address(
+        ctypes.addressof(bitmap._FT_Bitmap.buffer.contents))
+    arr = np.frombuffer(buf, dtype=np.uint8).reshape(rows, abs(pitch))
+    if pitch < 0:
+        arr = arr[::-1]
+    return arr[:, :width].astype(dtype, copy=False)
 
 class OutlinedGlyph(object):
-    def __init__(self, font, charcode):
+    def __init__(self, font, charcode, face=None):
         self.font = font
-        self.face = font.face
+        self.face = face if face is not None else font.face
 
         self.face.load_char(charcode, ft.FT_LOAD_DEFAULT | ft.FT_LOAD_NO_BITMAP)
 
@@ -263,13 +332,7 @@ class OutlinedGlyph(object):
         border = self.get_glyph(self.font.style.border_width)
         outline = self.get_glyph(self.font.style.border_width + self.font.style.outline_width)
 
-        (top, left, width, height), (fill, border, outline) = self.get_bitmaps(fill, border, outline)
-
-        outline = outline - border
-        border = border - fill
-
-        stack = np.dstack((fill, border, outline))
-        self.data = np.clip(stack * 255.0, 0, 255).astype(np.uint8)
+        (top, left, width, height), self.data = self.composite(fill, border, outline)
         self.top = top / self.font.hres
         self.left = left / self.font.hres
         self.pwidth = width
@@ -283,15 +346,17 @@ class OutlinedGlyph(object):
 
     def get_glyph(self, stroke=None):
         glyph = self.face.glyph.get_glyph()
-        if stroke is not None:
-            stroke_width = int(stroke * 64 * self.font.hres / 330)
-            stroker = ft.Stroker()
-            stroker.set(stroke_width, ft.FT_STROKER_LINECAP_ROUND, ft.FT_STROKER_LINEJOIN_ROUND, 0)
-            # StrokeBorder is not wrapped in freetype-py.Glyph...
-            error = ft.FT_Glyph_StrokeBorder(ft.byref(glyph._FT_Glyph), stroker._FT_Stroker, 0, 0)
-            if error:
-                raise ft.FT_Exception(error)
-        blyph = glyph.to_bitmap(ft.FT_RENDER_MODE_NORMAL, ft.Vector(0,0))
+        with _ft_lock:
+            if stroke is not None:
+                stroke_width = int(stroke * 64 * self.font.hres / 330)
+                stroker = ft.Stroker()
+                stroker.set(stroke_width, ft.FT_STROKER_LINECAP_ROUND, ft.FT_STROKER_LINEJOIN_ROUND, 0)
+                # StrokeBorder is not wrapped in freetype-py.Glyph...
+                error = ft.FT_Glyph_StrokeBorder(ft.byref(glyph._FT_Glyph), stroker._FT_Stroker, 0, 0)
+                del stroker
+                if error:
+                    raise ft.FT_Exception(error)
+            blyph = glyph.to_bitmap(ft.FT_RENDER_MODE_NORMAL, ft.Vector(0,0))
         blyph.glyph = glyph # keep a reference, otherwise it blows up
         return blyph
 
@@ -305,31 +370,291 @@ class OutlinedGlyph(object):
         #f_width, f_height = f_bitmap.width, f_bitmap.rows
         #f_data = bitmap_to_numpy(f_bitmap)/255.0
 
-    def get_bitmaps(self, *glyphs):
-        corners = []
-        for glyph in glyphs:
-            corners.append((glyph.top, glyph.left,
-                glyph.top - glyph.bitmap.rows,
-                glyph.left + glyph.bitmap.width))
-        corners = list(zip(*corners))
-        top, left, bot, right = max(corners[0]), min(corners[1]), min(corners[2]), max(corners[3])
+    def composite(self, fill, border, outline):
+        '''
+        Stack the fill, border and outline bitmaps into the channels of one
+        uint8 image, each stroke minus the one inside it.
+        '''
+        glyphs = fill, border, outline
+        top = max(glyph.top for glyph in glyphs)
+        left = min(glyph.left for glyph in glyphs)
+        bot = min(glyph.top - glyph.bitmap.rows for glyph in glyphs)
+        right = max(glyph.left + glyph.bitmap.width for glyph in glyphs)
 
         width = right - left
         height = top - bot
 
-        bitmaps = []
-        for glyph in glyphs:
-            expanded = np.zeros((height,width), dtype=np.float)
+        data = np.zeros((height, width, 3), dtype=np.uint8)
+        for i, glyph in enumerate(glyphs):
             dx = glyph.left - left
             dy = top - glyph.top
-            data = bitmap_to_numpy(glyph.bitmap, np.float) / 255.0
-            expanded[dy:dy+glyph.bitmap.rows, dx:dx+glyph.bitmap.width] = data
-            bitmaps.append(expanded)
+            data[dy:dy+glyph.bitmap.rows, dx:dx+glyph.bitmap.width, i] = \
+                bitmap_to_numpy(glyph.bitmap)
+
+        # Saturating a - b as a - min(a, b), outermost first
+        for i in (2, 1):
+            data[:, :, i] -= np.minimum(data[:, :, i], data[:, :, i - 1])
+
+        return (top, left, width, height), data
+
+FT_RENDER_MODE_SDF = 5
+_sdf_spread = None
+
+def _freetype_sdf(spread):
+    """
+    Set up FreeType's own SDF renderer (FreeType 2.11+) for the given
+    spread. Returns False if it is not available.
+    """
+    global _sdf_spread
+    if ft.version() < (2, 11, 0):
+        return False
+    with _ft_lock:
+        if _sdf_spread != spread:
+            value = ctypes.c_int(spread)
+            if ft.raw.FT_Property_Set(ft.get_handle(), b"sdf", b"spread",
+                                      ctypes.byref(value)):
+                return False
+            _sdf_spread = spread
+    return True
+
+def distance_transform(features):
+    """
+    Euclidean distance from each pixel to the nearest pixel where features
+    is true, computed as a vertical scan followed by a brute force
+    horizontal pass.
+    """
+    h, w = features.shape
+    g = np.where(features, 0, h + w).astype(np.float32)
+    for y in range(1, h):
+        np.minimum(g[y], g[y-1] + 1, out=g[y])
+    for y in range(h-2, -1, -1):
+        np.minimum(g[y], g[y+1] + 1, out=g[y])
+    xs = np.arange(w)
+    d2 = g[:, None, :] ** 2 + ((xs[:, None] - xs[None, :]) ** 2)[None]
+    return np.sqrt(d2.min(axis=2))
+
+class SDFGlyph(object):
+    """
+    Glyph as a signed distance field, rendered once per font file at SIZE
+    pixels per em regardless of the font size and style. The fill, border
+    and outline are cut out of it in the shader (fs_karaoke_sdf), using the
+    per-style thresholds in self.strokes.
+    """
+    SIZE = 48
+    SPREAD = 10
+
+    def __init__(self, font, charcode, face=None):
+        self.font = font
+        face = face if face is not None else font.face
+
+        face.load_char(charcode, ft.FT_LOAD_DEFAULT | ft.FT_LOAD_NO_BITMAP)
+        self.dy = font.ft2screen(face.glyph.advance.y)
+        self.dx = font.ft2screen(face.glyph.advance.x)
+
+        ident = ("SDF", font.cache_ident[:3], self.SIZE, self.SPREAD)
+        field = None
+        if font.cache is not None:
+            field = font.cache.get(ident, charcode)
+        if field is None:
+            field = self.render_field(font, charcode)
+            if font.cache is not None:
+                font.cache.put(ident, charcode, field)
+        self.data, top, left = field
+        self.atlas_key = (ident, charcode)
+
+        # field pixels -> screen pixels
+        scale = font.size * font.hres / 4 / 72 / self.SIZE
+        height, width = self.data.shape[:2]
+        self.top = top * scale / font.hres
+        self.left = left * scale / font.hres
+        self.pwidth = width
+        self.pheight = height
+        self.width = width * scale / font.hres
+        self.height = height * scale / font.hres
+        self.bot = self.top - self.height
+        self.right = self.left + self.width
+
+        # Same stroke widths as OutlinedGlyph, in field units where the edge
+        # is at 0.5 and SPREAD pixels is 0.5
+        def threshold(stroke):
+            radius = stroke * font.hres / 330 / scale
+            return max(0, 0.5 - radius / (2 * self.SPREAD))
+        style = font.style
+        self.strokes = (
+            threshold(style.border_width),
+            threshold(style.border_width + style.outline_width),
+            min(1, 0.5 / scale / (2 * self.SPREAD)))
+
+    @classmethod
+    def render_field(cls, font, charcode):
+        face = _thread_face(font.filename, cls.SIZE, 72 * 4)
+        if _freetype_sdf(cls.SPREAD):
+            face.load_char(charcode, ft.FT_LOAD_DEFAULT)
+            with _ft_lock:
+                face.glyph.render(FT_RENDER_MODE_SDF)
+            bitmap = face.glyph.bitmap
+            data = np.zeros((bitmap.rows, bitmap.width, 3), np.uint8)
+            if bitmap.rows and bitmap.width:
+                data[:, :, 0] = bitmap_to_numpy(bitmap)
+            return data, face.glyph.bitmap_top, face.glyph.bitmap_left
+
+        # Older FreeType: distance field of the thresholded bitmap
+        with _ft_lock:
+            face.load_char(charcode, ft.FT_LOAD_RENDER)
+        bitmap = face.glyph.bitmap
+        pad = cls.SPREAD
+        inside = np.zeros((bitmap.rows + 2 * pad, bitmap.width + 2 * pad), bool)
+        if bitmap.rows and bitmap.width:
+            inside[pad:-pad, pad:-pad] = bitmap_to_numpy(bitmap) >= 128
+        dist_in = distance_transform(~inside)
+        dist_out = distance_transform(inside)
+        dist = np.where(inside, dist_in - 0.5, 0.5 - dist_out)
+        value = np.clip(0.5 + dist / (2 * pad), 0, 1)
+        data = np.zeros(inside.shape + (3,), np.uint8)
+        data[:, :, 0] = np.round(value * 255)
+        return data, face.glyph.bitmap_top + pad, face.glyph.bitmap_left - pad
+
+class CachedGlyph(object):
+    """
+    The atlas independent part of a rendered glyph: its bitmap and metrics.
+    """
+    FIELDS = ("data", "top", "left", "pwidth", "pheight", "width", "height",
+              "bot", "right", "dx", "dy", "strokes", "atlas_key")
+
+    def __init__(self, glyph=None):
+        if glyph is not None:
+            for field in self.FIELDS:
+                setattr(self, field, getattr(glyph, field, None))
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.FIELDS, state):
+            setattr(self, field, value)
+
+class GlyphCache(object):
+    """
+    Rendered glyphs by font (file, size, border and outline width,
+    resolution) and character, kept across songs and, if directory is set,
+    stored on disk with one file per font. Also holds kerning tables, by
+    face and character pair. Nothing is written until save() is called,
+    which rewrites each changed font file, so callers batch it. At most size
+    fonts are kept in memory, least recently used first out; fonts with
+    unsaved changes stay until they are saved.
+    """
+    VERSION = 3
+
+    def __init__(self, directory=None, size=32):
+        self.directory = directory
+        self.size = size
+        self.lock = threading.Lock()
+        self.fonts = OrderedDict()
+        self.dirty = set()
+
+    def _path(self, ident):
+        name = hashlib.sha1(repr(ident).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".glyphs")
+
+    def _load(self, ident):
+        if not self.directory:
+            return {}
+        path = self._path(ident)
+        try:
+            with open(path, "rb") as fd:
+                version, file_ident, glyphs = pickle.load(fd)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print("Glyph cache %s unusable, ignoring: %r" % (path, e))
+            return {}
+        if version != self.VERSION or file_ident != ident:
+            return {}
+        return glyphs
+
+    def _font(self, ident):
+        glyphs = self.fonts.get(ident)
+        if glyphs is None:
+            glyphs = self.fonts[ident] = self._load(ident)
+            self._evict()
+        else:
+            self.fonts.move_to_end(ident)
+        return glyphs
+
+    def _evict(self):
+        # Never evicts the most recently used font, which the caller is using
+        excess = len(self.fonts) - max(1, self.size)
+        for ident in list(self.fonts)[:-1]:
+            if excess <= 0:
+                break
+            if ident in self.dirty:
+                if self.directory:
+                    continue
+                self.dirty.discard(ident)
+            del self.fonts[ident]
+            excess -= 1
+
+    def get(self, ident, charcode):
+        with self.lock:
+            return self._font(ident).get(charcode)
+
+    def put(self, ident, charcode, glyph):
+        with self.lock:
+            self._font(ident)[charcode] = glyph
+            self.dirty.add(ident)
+
+    def save(self):
+        with self.lock:
+            fonts = [(ident, dict(self.fonts[ident])) for ident in self.dirty]
+            self.dirty.clear()
+            self._evict()
+        if not self.directory:
+            return
+        for ident, glyphs in fonts:
+            path = self._path(ident)
+            tmp = "%s.%d.tmp" % (path, threading.get_ident())
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(tmp, "wb") as fd:
+                    pickle.dump((self.VERSION, ident, glyphs), fd,
+                                pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except OSError as e:
+                print("Failed to write glyph cache %s: %r" % (path, e))
+
+glyph_cache = GlyphCache()
+
+# FreeType faces must not be used from several threads at once, so render
+# workers get a face per thread. freetype-py creates every face and stroker
+# from one process-wide FT_Library, which FreeType only allows with a lock
+# around everything that goes through it: creating and destroying faces,
+# stroking and rasterizing. Reentrant, as a face may be collected while the
+# lock is held.
+_ft_lock = threading.RLock()
+_thread_faces = threading.local()
+
+class _Face(ft.Face):
+    def __init__(self, filename):
+        with _ft_lock:
+            ft.Face.__init__(self, filename)
 
-        return (top, left, width, height), bitmaps
+    def __del__(self):
+        with _ft_lock:
+            ft.Face.__del__(self)
+
+def _thread_face(filename, size, hres):
+    faces = _thread_faces.__dict__.setdefault("faces", {})
+    key = (filename, size, hres)
+    face = faces.get(key)
+    if face is None:
+        face = _Face(filename)
+        face.set_char_size(int(size * 64), hres=int(hres / 4), vres=int(hres / 4))
+        faces[key] = face
+    return face
 
 class TextureFont(object):
-    def __init__(self, hres, atlas, filename, size, style, glyphclass=OutlinedGlyph):
+    def __init__(self, hres, atlas, filename, size, style, glyphclass=OutlinedGlyph,
+                 cache=glyph_cache):
         self.hres = hres
         self.atlas = atlas
         assert atlas.depth == 3
@@ -338,7 +663,7 @@ class TextureFont(object):
         self.style = style
         self.glyphs = {}
         self.glyphclass = glyphclass
-        self.face = ft.Face(self.filename)
+        self.face = _Face(self.filename)
         self.face.set_char_size(int(self.size * 64), hres=int(self.hres / 4), vres=int(self.hres / 4))
         self._dirty = True
         metrics = self.face.size
@@ -347,6 +672,15 @@ class TextureFont(object):
         self.height = self.ft2screen(metrics.height)
         self.linegap = self.height - self.ascender + self.descender
         self.depth = atlas.depth
+        self.cache = cache
+        st = os.stat(self.filename)
+        self.cache_ident = (os.path.abspath(self.filename), st.st_mtime_ns,
+                            st.st_size, self.size, self.style.border_width,
+                            self.style.outline_width, self.hres,
+                            self.glyphclass.__name__)
+        # Kerning only depends on the face and its size
+        self.kerning = {}
+        self.kerning_ident = ("kerning",) + self.cache_ident[:4] + (self.hres,)
 
     def ft2screen(self, c):
         return int((c + 32) / 64) / float(self.hres)
@@ -355,24 +689,96 @@ class TextureFont(object):
         if charcode in self.glyphs:
             return self.glyphs[charcode]
 
-        glyph = self.glyphclass(self, charcode)
-        region = self.atlas.get_region(glyph.pwidth+2, glyph.pheight+2)
-        if region is None:
-            raise Exception("Atlas is full")
-        x, y, w, h = region
-        x += 1
-        y += 1
-        w -= 2
-        h -= 2
-        self.atlas.set_region((x, y, w, h), glyph.data)
+        glyph = None
+        if self.cache is not None:
+            glyph = self.cache.get(self.cache_ident, charcode)
+        if glyph is None:
+            glyph = self.render_glyph(charcode)
+        return self.add_glyph(charcode, glyph)
+
+    def missing_glyphs(self, chars):
+        return [c for c in chars if c not in self.glyphs and
+                (self.cache is None or self.cache.get(self.cache_ident, c) is None)]
+
+    def render_glyph(self, charcode, threaded=False):
+        """
+        Renders a glyph without adding it to the atlas. With threaded, uses
+        a FreeType face private to the calling thread.
+        """
+        face = _thread_face(self.filename, self.size, self.hres) if threaded else None
+        glyph = CachedGlyph(self.glyphclass(self, charcode, face))
+        if self.cache is not None:
+            self.cache.put(self.cache_ident, charcode, glyph)
+        return glyph
+
+    def add_glyph(self, charcode, glyph):
+        return add_glyphs(self.atlas, [(self, charcode, glyph)])[0]
+
+    def _place_glyph(self, charcode, glyph, region):
+        glyph.page, x, y, w, h = region
         glyph.tex_top = y / float(self.atlas.height)
-        glyph.tex_bot = glyph.tex_top + (h / float(self.atlas.width))
-        glyph.tex_left = x / float(self.atlas.height)
+        glyph.tex_bot = glyph.tex_top + (h / float(self.atlas.height))
+        glyph.tex_left = x / float(self.atlas.width)
         glyph.tex_right = glyph.tex_left + (w / float(self.atlas.width))
         self.glyphs[charcode] = glyph
         self._dirty = True
         return glyph
 
     def get_kerning(self, prev, cur):
-        kern = self.face.get_kerning(prev, cur)
-        return self.ft2screen(kern.x), self.ft2screen(kern.x)
+        pair = prev, cur
+        kern = self.kerning.get(pair)
+        if kern is None:
+            kern = self.prebuild_kerning([pair])[pair]
+        return kern
+
+    def prebuild_kerning(self, pairs):
+        """
+        Fills the kerning table for pairs, looking up in FreeType only those
+        that are neither in the table nor in the cache. Returns the table.
+        """
+        for pair in pairs:
+            if pair in self.kerning:
+                continue
+            if not self.face.has_kerning:
+                self.kerning[pair] = 0.0, 0.0
+                continue
+            kern = None
+            if self.cache is not None:
+                kern = self.cache.get(self.kerning_ident, pair)
+            if kern is None:
+                x = self.face.get_kerning(*pair).x
+                kern = self.ft2screen(x), self.ft2screen(x)
+                if self.cache is not None:
+                    self.cache.put(self.kerning_ident, pair, kern)
+            self.kerning[pair] = kern
+        return self.kerning
+
+def add_glyphs(atlas, items):
+    """
+    Add rendered glyphs to their fonts, packing them into atlas together,
+    tallest first. items is a list of (font, charcode, glyph), where all the
+    fonts use atlas. Returns the added glyphs.
+    """
+    items = [(font, charcode, copy.copy(glyph)) for font, charcode, glyph in items]
+    keys = [glyph.atlas_key if glyph.atlas_key is not None else id(glyph)
+            for font, charcode, glyph in items]
+    # Glyphs with an atlas_key (SDFGlyph) share one bitmap across fonts
+    regions = {}
+    pending = {}
+    for key, (font, charcode, glyph) in zip(keys, items):
+        if glyph.atlas_key in atlas.shared:
+            regions[key] = atlas.shared[glyph.atlas_key]
+        elif key not in pending:
+            pending[key] = glyph
+    sizes = [(glyph.pwidth+2, glyph.pheight+2) for glyph in pending.values()]
+    for (key, glyph), region in zip(pending.items(), atlas.get_regions(sizes)):
+        if region is None:
+            raise Exception("Glyph too large for the atlas")
+        page, x, y, w, h = region
+        region = page, x + 1, y + 1, w - 2, h - 2
+        atlas.set_region(region, glyph.data)
+        regions[key] = region
+        if glyph.atlas_key is not None:
+            atlas.shared[glyph.atlas_key] = region
+    return [font._place_glyph(charcode, glyph, regions[key])
+            for key, (font, charcode, glyph) in zip(keys, items)]
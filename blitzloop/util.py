@@ -71,6 +71,16 @@ def init_argparser():
     parser.add_argument(
         '--instant', default=False, action='store_true',
         help='use instant syllable display instead of scrolling')
+    parser.add_argument(
+        '--glyph-workers', default=0, type=int,
+        help='threads used to render glyphs (0 = one per CPU)')
+    parser.add_argument(
+        '--sdf-glyphs', default=False, action='store_true',
+        help='render glyphs as signed distance fields, shared by all sizes '
+             'and styles of a font')
+    parser.add_argument(
+        '--no-batching', default=False, action='store_true',
+        help='draw each lyrics line from its own vertex buffer')
 
 def get_argparser():
     return configargparse.get_argument_parser()
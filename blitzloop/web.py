@@ -167,16 +167,26 @@ def get_qe_config(qe):
         "pause": qe.pause,
     }
 
+def get_db_song(id):
+    try:
+        song = database.songs[id]
+    except IndexError:
+        song = None
+    if song is None: # removed by a rescan
+        raise HTTPError(404)
+    return song
+
 @route("/songlist")
 def get_songlist():
     songs = []
     for i, song in enumerate(database.songs):
-        songs.append({"id": i, "meta": get_song_meta(song)})
+        if song is not None:
+            songs.append({"id": i, "meta": get_song_meta(song)})
     return {"songs": songs}
 
 @route("/song/<id:int>")
 def get_song(id):
-    song = database.songs[id]
+    song = get_db_song(id)
     variants = ((k, v.name) for k, v in song.variants.items())
     return {
         "id": id,
@@ -188,7 +198,7 @@ def get_song(id):
 
 @route("/song/<id:int>/cover/<size:int>")
 def get_songcover(id, size):
-    song = database.songs[id]
+    song = get_db_song(id)
     coverfile = song.coverfile
     if coverfile is None:
         return redirect("/s/no_cover/%d" % size)
@@ -235,7 +245,7 @@ def apply_qe(qe, json):
 
 @route("/queue/add/<id:int>", method="POST")
 def queue_add(id):
-    song = database.songs[id]
+    song = get_db_song(id)
     qe = songlist.SongQueueEntry(song)
     apply_qe(qe, request.json)
     queue.add(qe)
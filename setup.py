@@ -39,6 +39,7 @@ setup(
             'console_scripts': [
                 'blitzloop = blitzloop.main:entry',
                 'blitzloop-single = blitzloop.play:entry',
+                'blitzloop-compile = blitzloop.blitzc:entry',
             ]
         },
         setup_requires=extra_requires,
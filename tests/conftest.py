@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Run from the top of the tree with: python -m pytest tests
+
+import pytest
+
+# Covers ruby text, several formats and variants, Fraction, mixed fraction
+# and Decimal timing, a compound with a start but no steps, and one with no
+# timing at all.
+SONG = """\
+[Meta]
+title=朝の歌
+title[l]=Asa no Uta
+artist=Test Artist
+
+[Song]
+audio=song.flac
+
+[Timing]
+@0.5=0
+@60.25=120
+@200=400
+
+[Formats]
+J=Japanese
+R=Romaji
+E=English
+
+[Styles]
+{japanese}
+font=TestFont.ttf
+size=15
+outline_width=0.15
+border_width=0.8
+colors=ffffff,008069,000000
+colors_on=208040,ffffff,000000
+
+{romaji}
+font=TestFont.ttf
+size=12
+colors=ffffff,008069,000000
+colors_on=208040,ffffff,000000
+
+[Variants]
+{japanese}
+name=日本語
+tags=J
+style=japanese
+
+{both}
+name=日本語 + romaji
+tags=J,R,E
+J.style=japanese
+R.style=romaji
+R.edge=top
+E.style=romaji
+
+[Lyrics]
+J: {朝}(あさ)の{光}(ひかり)が{窓}(まど)を{叩}(たた)く$
+R: asa no hikari ga mado wo tataku$
+@: 4  1 1/2 1/2 1 3/4 1/4 1 1/2 1/2 1 1/2 1/2 1
+
+J: {静}(しず)かな{町}(まち)に{歌}(うた)が{響}(ひび)く
+R: shizuka na machi ni uta ga hibiku
+@: 20.5  0.5 0.25 0.25 1.0 1.0 0.5 0.5 1.0 0.75 0.75 0.5 1.0 2.0
+
+J: ララ
+R: rara
+@: 32+1/3  1/3 2
+
+J: ラ
+@: 40
+
+E: the morning light is calling
+"""
+
+@pytest.fixture
+def song_path(tmp_path):
+    path = tmp_path / "song.blitz"
+    path.write_text(SONG, encoding="utf-8")
+    return str(path)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import numpy as np
+import pytest
+
+from blitzloop import bench, texture_font
+
+def glyph_sizes(seed, count):
+    rng = np.random.RandomState(seed)
+    return [(int(w), int(h)) for w, h in zip(rng.randint(4, 60, count),
+                                             rng.randint(4, 70, count))]
+
+def assert_packed(atlas, sizes, regions):
+    # Every region has the size asked for, lies inside the atlas and does
+    # not overlap any other
+    cover = np.zeros((atlas.height, atlas.width), np.int32)
+    for (width, height), region in zip(sizes, regions):
+        if region is None:
+            continue
+        x, y, w, h = region
+        assert (w, h) == (width, height)
+        assert 0 <= x and x + w <= atlas.width
+        assert 0 <= y and y + h <= atlas.height
+        cover[y:y + h, x:x + w] += 1
+    assert cover.max() <= 1
+    assert cover.sum() == atlas.used
+
+@pytest.mark.parametrize("seed", range(3))
+def test_get_region_matches_legacy_packer(seed):
+    sizes = glyph_sizes(seed, 600)
+    legacy = bench.LegacyTextureAtlas(512, 512, 1)
+    atlas = texture_font.TextureAtlas(512, 512, 1)
+    expected = [legacy.get_region(*size) for size in sizes]
+    regions = [atlas.get_region(*size) for size in sizes]
+    assert regions == expected
+    assert None in regions
+    assert_packed(atlas, sizes, regions)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_get_regions_packs_everything(seed):
+    sizes = glyph_sizes(seed, 300)
+    atlas = texture_font.TextureAtlas(1024, 1024, 1)
+    regions = atlas.get_regions(sizes)
+    assert None not in regions
+    assert_packed(atlas, sizes, regions)
+
+def test_get_regions_when_full():
+    sizes = glyph_sizes(0, 600)
+    atlas = texture_font.TextureAtlas(256, 256, 1)
+    regions = atlas.get_regions(sizes + [(300, 10)])
+    assert regions[-1] is None
+    assert None in regions[:-1]
+    assert_packed(atlas, sizes, regions)
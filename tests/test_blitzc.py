@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+
+import pytest
+
+from blitzloop import blitzc, song
+
+def atom_times(s):
+    times = []
+    for compound in s.compounds:
+        for tag, molecule in compound.items():
+            step = 0
+            for atom in molecule.atoms:
+                times.append(compound.get_atom_time(step, atom.steps))
+                step += atom.steps
+    return times
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_round_trip(song_path, lazy, monkeypatch):
+    monkeypatch.setattr(song, "body_cache", song.BodyCache())
+    source = song.Song(song_path)
+    assert blitzc.compile_file(song_path)
+    compiled = blitzc.load_if_fresh(song_path, lazy)
+    assert isinstance(compiled, blitzc.CompiledSong)
+    assert compiled.dump() == source.dump()
+    assert compiled.timing.beats == source.timing.beats
+    assert atom_times(compiled) == atom_times(source)
+    for a, b in zip(compiled.compounds, source.compounds):
+        assert a.start == b.start and type(a.start) is type(b.start)
+        assert a.timing == b.timing
+        if a.timing:
+            assert [type(t) for t in a.timing] == [type(t) for t in b.timing]
+
+def test_compile_file_skips_fresh(song_path):
+    assert blitzc.compile_file(song_path)
+    assert not blitzc.compile_file(song_path)
+    assert blitzc.compile_file(song_path, force=True)
+
+def test_stale_source_is_not_loaded(song_path):
+    blitzc.compile_file(song_path)
+    with open(song_path, "a", encoding="utf-8") as fd:
+        fd.write("\nE: one more line\n")
+    assert blitzc.load_if_fresh(song_path) is None
+    assert blitzc.compile_file(song_path)
+    assert len(blitzc.load_if_fresh(song_path).compounds) == 6
+
+def test_damaged_file_is_not_loaded(song_path):
+    blitzc.compile_file(song_path)
+    cpath = blitzc.compiled_path(song_path)
+    with open(cpath, "rb") as fd:
+        data = fd.read()
+    with open(cpath, "wb") as fd:
+        fd.write(data[:-10])
+    assert blitzc.load(song_path) is None
+    with open(cpath, "wb") as fd:
+        fd.write(b"XXXX" + data[4:])
+    assert blitzc.load(song_path) is None
+    os.remove(cpath)
+    assert blitzc.load(song_path) is None
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import itertools
+import pickle
+import random
+
+import pytest
+
+from blitzloop import bench, layout, song
+
+class FakeGlyph(object):
+    def __init__(self, dx):
+        self.dx = dx
+        self.dy = 0
+
+class FakeFont(object):
+    # Uneven advances and kerning, so that any difference in the order of
+    # the pen arithmetic shows up in the last bits
+    def __init__(self, scale):
+        self.scale = scale
+        self.ascender = 0.8 * scale
+        self.descender = -0.2 * scale
+        self.glyphs = {}
+
+    def get_glyph(self, c):
+        if c not in self.glyphs:
+            self.glyphs[c] = FakeGlyph(self.scale * (ord(c) % 7 + 3) / 7.0)
+        return self.glyphs[c]
+
+    def get_kerning(self, a, b):
+        return self.scale * ((ord(a) + ord(b)) % 5 - 2) / 31.0, 0
+
+GEOMETRY = layout.LayoutGeometry(1280, 720)
+
+def song_molecules(song_path):
+    s = song.Song(song_path)
+    return [(compound, molecule) for compound in s.compounds
+            for tag, molecule in compound.items()]
+
+@pytest.mark.parametrize("ruby_expand", [0, 1])
+@pytest.mark.parametrize("ruby", [False, True])
+def test_measure_matches_add(song_path, ruby_expand, ruby):
+    font = FakeFont(0.03)
+    ruby_font = FakeFont(0.013) if ruby else None
+    style = song.Style(None)
+    molecules = song_molecules(song_path)
+    for (c1, m1), (c2, m2) in itertools.product([(None, None)] + molecules,
+                                                molecules):
+        line = layout.DisplayLine(GEOMETRY)
+        line.layout_options["ruby_expand"] = ruby_expand
+        if m1 is not None:
+            line.add(m1, c1.get_atom_time, style, font, ruby_font)
+        width = line.measure(m2, font, ruby_font)
+        added = line.copy()
+        added.add(m2, c2.get_atom_time, style, font, ruby_font)
+        assert width == added.px
+
+def row_layout():
+    song_layout = layout.SongLayout.__new__(layout.SongLayout)
+    song_layout.renderer = bench.HeadlessRenderer(1280, 720)
+    song_layout.geometry = layout.LayoutGeometry.of(song_layout.renderer.display)
+    return song_layout
+
+def place(layout_lines, lines, top):
+    song_layout = row_layout()
+    try:
+        layout_lines(song_layout, list(lines), top)
+    except IndexError:
+        return None
+    return bench.line_positions(lines)
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("count", [50, 300])
+@pytest.mark.parametrize("duet", [False, True])
+@pytest.mark.parametrize("top", [False, True])
+def test_rows_match_legacy_scan(seed, count, duet, top):
+    expected = place(bench.legacy_layout_lines,
+                     bench.synthetic_lines(count, duet, seed), top)
+    positions = place(layout.SongLayout._layout_lines,
+                      bench.synthetic_lines(count, duet, seed), top)
+    assert expected is not None
+    assert positions == expected
+
+def test_rows_run_out_like_legacy_scan():
+    def crowded_lines():
+        # More lines on screen at once than there are rows
+        lines = bench.synthetic_lines(12, False, 0)
+        for l in lines:
+            l._start_t, l._end_t = 10.0, 20.0
+            l.start, l.end = l.lim_start, l.lim_end
+        return lines
+    assert place(bench.legacy_layout_lines, crowded_lines(), False) is None
+    assert place(layout.SongLayout._layout_lines, crowded_lines(), False) is None
+
+class FakeStyle(object):
+    def __init__(self, colors, colors_on):
+        self.colors = colors
+        self.colors_on = colors_on
+
+def random_store(rng, count):
+    # A GlyphStore and the plain list of per-glyph rows it stands for
+    glyphs = [FakeGlyph(i) for i in range(5)]
+    styles = [FakeStyle(((i, 0, 0),), ((0, i, 0),)) for i in range(3)]
+    store = layout.GlyphStore()
+    rows = []
+    for i in range(count):
+        op = rng.random()
+        if op < 0.7 or not rows:
+            glyph, style = rng.choice(glyphs), rng.choice(styles)
+            x, y = rng.uniform(0, 1), rng.uniform(0, 1)
+            store.append(glyph, x, y, style)
+            rows.append([glyph, (style.colors, style.colors_on), x, y, 0, 0, 0, 0])
+        elif op < 0.85:
+            first = rng.randrange(len(rows))
+            last = rng.randint(first, len(rows))
+            timing = [rng.uniform(0, 1), rng.uniform(0, 1),
+                      rng.uniform(0, 100), rng.uniform(0, 100)]
+            store.set_timing(first, last, *timing)
+            for row in rows[first:last]:
+                row[4:] = timing
+        else:
+            first, dx = rng.randrange(len(rows)), rng.uniform(-0.1, 0.1)
+            store.shift(first, dx)
+            for row in rows[first:]:
+                row[2] += dx
+                row[4] += dx
+                row[5] += dx
+    return store, rows
+
+def assert_store_matches(store, rows):
+    assert len(store) == len(rows)
+    assert [store.glyph_table[i] for i in store.glyph_id] == [r[0] for r in rows]
+    assert [store.palette_table[i] for i in store.palette_id] == [r[1] for r in rows]
+    for i, name in enumerate(store.COLUMNS):
+        column = store.column(name)
+        assert column.dtype == "float64"
+        assert column.tolist() == [r[2 + i] for r in rows]
+    assert len(set(map(id, store.glyph_table))) == len(store.glyph_table)
+    assert len(set(store.palette_table)) == len(store.palette_table)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_glyph_store_matches_list(seed):
+    store, rows = random_store(random.Random(seed), 300)
+    assert_store_matches(store, rows)
+    assert len(store.glyph_table) == 5
+    assert len(store.palette_table) == 3
+
+def test_glyph_store_copy_is_independent():
+    rng = random.Random(0)
+    store, rows = random_store(rng, 100)
+    copy = store.copy()
+    assert_store_matches(copy, rows)
+    glyph = store.glyph_table[0]
+    copy.append(glyph, 0.5, 0.5, FakeStyle(((9, 9, 9),), ((9, 9, 9),)))
+    copy.shift(0, 1.0)
+    copy.set_timing(0, len(copy), 0, 0, 0, 0)
+    assert_store_matches(store, rows)
+    assert copy.glyph_table[copy.glyph_id[-1]] is glyph
+    assert len(copy.glyph_table) == len(store.glyph_table)
+    assert len(copy.palette_table) == len(store.palette_table) + 1
+
+def test_glyph_store_load_round_trip():
+    store, rows = random_store(random.Random(1), 100)
+    arrays = pickle.loads(pickle.dumps(
+        [getattr(store, name) for name in store.ARRAYS],
+        pickle.HIGHEST_PROTOCOL))
+    loaded = layout.GlyphStore()
+    loaded.load(store.glyph_table, store.palette_table, arrays)
+    assert_store_matches(loaded, rows)
+    assert loaded.column("glyph_id").dtype == "int64"
+    # Appending known glyphs and palettes reuses their table entries
+    loaded.append(store.glyph_table[2], 0, 0, FakeStyle(*store.palette_table[1]))
+    assert (loaded.glyph_id[-1], loaded.palette_id[-1]) == (2, 1)
+    assert len(loaded.glyph_table) == len(store.glyph_table)
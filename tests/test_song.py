@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import threading
+
+from blitzloop import song
+
+def lazy_songs(path, count):
+    return [song.Song(path, lazy=True) for i in range(count)]
+
+def test_lazy_song_matches_eager(song_path, monkeypatch):
+    monkeypatch.setattr(song, "body_cache", song.BodyCache())
+    eager = song.Song(song_path)
+    lazy = song.Song(song_path, lazy=True)
+    assert lazy._body is None
+    assert lazy.dump() == eager.dump()
+
+def test_body_cache_evicts_least_recently_used(song_path, monkeypatch):
+    cache = song.BodyCache(size=2)
+    monkeypatch.setattr(song, "body_cache", cache)
+    a, b, c = lazy_songs(song_path, 3)
+    a.variants
+    b.variants
+    a.variants
+    c.variants
+    assert list(cache.bodies) == [a, c]
+    assert b.variants is not None
+    assert list(cache.bodies) == [c, b]
+
+def test_body_cache_parses_each_song_once(song_path, monkeypatch):
+    cache = song.BodyCache()
+    monkeypatch.setattr(song, "body_cache", cache)
+    s, = lazy_songs(song_path, 1)
+    parses = []
+    parse_body = song.Song.parse_body
+    def counting_parse_body(self):
+        parses.append(self)
+        return parse_body(self)
+    monkeypatch.setattr(song.Song, "parse_body", counting_parse_body)
+    threads = [threading.Thread(target=lambda: s.compounds) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert parses == [s]
+    assert not cache.pending
+
+def test_assigning_to_lazy_song_pins_body(song_path, monkeypatch):
+    cache = song.BodyCache(size=1)
+    monkeypatch.setattr(song, "body_cache", cache)
+    a, b = lazy_songs(song_path, 2)
+    a.compounds = a.compounds[:2]
+    b.compounds
+    assert a not in cache.bodies
+    assert len(a.compounds) == 2
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2013 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import random
+
+import numpy as np
+import pytest
+
+from blitzloop import song
+
+# The original linear scans, which the bisecting BeatCounter must match
+# bit for bit
+
+def linear_time2beat(beats, t):
+    time1 = None
+    for time2, beat2 in beats:
+        if time2 > t:
+            if time1 is None:
+                return 0
+            else:
+                frac = (t - time1) / (time2 - time1)
+                return beat1 + frac * (beat2 - beat1)
+        time1, beat1 = time2, beat2
+    time1, beat1 = beats[-2]
+    frac = (t - time1) / (time2 - time1)
+    return beat1 + frac * (beat2 - beat1)
+
+def linear_beat2time(beats, beat):
+    beat = float(beat)
+    beat1 = None
+    for time2, beat2 in beats:
+        if beat2 > beat:
+            if beat1 is None:
+                return 0
+            else:
+                frac = (beat - beat1) / (beat2 - beat1)
+                return time1 + frac * (time2 - time1)
+        time1, beat1 = time2, beat2
+    time1, beat1 = beats[-2]
+    frac = (beat - beat1) / (beat2 - beat1)
+    return time1 + frac * (time2 - time1)
+
+def random_counter(rng, points):
+    counter = song.BeatCounter()
+    t = rng.uniform(0, 5)
+    beat = 0
+    for i in range(points):
+        counter.add(t, beat)
+        t += rng.uniform(0.1, 20)
+        beat += rng.randint(1, 64)
+    return counter
+
+def probes(rng, values):
+    # Points before, on, between and after the control points
+    lo, hi = values[0], values[-1]
+    return ([lo - 10, lo, hi, hi + 10] + list(values) +
+            [rng.uniform(lo - 1, hi + 1) for i in range(200)])
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("points", [2, 3, 50])
+def test_lookups_match_linear_scan(seed, points):
+    rng = random.Random(seed)
+    counter = random_counter(rng, points)
+    beats = list(counter.beats)
+    for t in probes(rng, [t for t, b in beats]):
+        assert counter.time2beat(t) == linear_time2beat(beats, t)
+    beat_probes = probes(rng, [b for t, b in beats])
+    expected = [linear_beat2time(beats, b) for b in beat_probes]
+    assert [counter.beat2time(b) for b in beat_probes] == expected
+    assert counter.beat2time_many(np.array(beat_probes)).tolist() == expected
+
+def test_changes_invalidate_lookups():
+    counter = song.BeatCounter()
+    for t, b in [(0.0, 0), (10.0, 10), (20.0, 20)]:
+        counter.add(t, b)
+    assert counter.beat2time(15) == 15.0
+    counter.set_beat(1, 12.0, 10)
+    assert counter.beat2time(15) == linear_beat2time(counter.beats, 15) == 16.0
+    assert counter.beat2time_many([15]).tolist() == [16.0]
+    counter.add(40.0, 30)
+    assert counter.time2beat(30.0) == linear_time2beat(counter.beats, 30.0)
+    with pytest.raises(AttributeError):
+        counter.beats.append((50.0, 40))
+
+def summed_atom_time(compound, steps, length):
+    # The original Compound.get_atom_time, re-summing the exact timing
+    if compound.timing:
+        start = compound.start + sum(compound.timing[i] for i in range(steps))
+        end = start + sum(compound.timing[i] for i in range(steps, steps + length))
+        return (compound.song_timing.beat2time(start),
+                compound.song_timing.beat2time(end))
+    single = compound.song_timing.beat2time(compound.start)
+    return single, single
+
+def atom_spans(compound):
+    for tag, molecule in compound.items():
+        step = 0
+        for atom in molecule.atoms:
+            yield step, atom.steps
+            if atom.particles:
+                par_step = step
+                for particle in atom.particles:
+                    yield par_step, particle.steps
+                    par_step += particle.steps
+            step += atom.steps
+
+@pytest.mark.parametrize("precompute", [False, True])
+def test_atom_times_match_summing(song_path, precompute):
+    s = song.Song(song_path)
+    if precompute:
+        s.precompute_timing()
+    timed = [c for c in s.compounds if c.is_timed]
+    assert len(timed) == 4
+    for compound in timed:
+        for steps, length in atom_spans(compound):
+            assert (compound.get_atom_time(steps, length) ==
+                    summed_atom_time(compound, steps, length))
+
+def test_atom_times_follow_timing_edits(song_path):
+    s = song.Song(song_path)
+    s.precompute_timing()
+    compound = s.compounds[2]
+    compound.timing.append(song.MixedFraction("1/2"))
+    assert compound.get_atom_time(2, 1) == summed_atom_time(compound, 2, 1)
+    compound.timing = [song.MixedFraction(1)] * 2
+    assert compound.get_atom_time(0, 2) == summed_atom_time(compound, 0, 2)
+    compound.start = song.MixedFraction(50)
+    assert compound.get_atom_time(0, 1) == summed_atom_time(compound, 0, 1)